@@ -0,0 +1,452 @@
+'''
+Dominion Markov
+Author: Tristan Miller
+This contains a declarative description of decks, which is compiled into Monte Carlo and Markov sims
+'''
+import numpy as np
+from dominionMarkov import monte_sim, markov_sim, monte_lab_fin
+from dominionKernels import deck_turns
+
+#######################################
+########## Card definitions ###########
+#######################################
+
+#A deck is described by a list of action cards, in order of play priority: each action, the first card in the list
+#that is in hand gets played.  Every other card in the deck is a copper, and the payoff is the number of coppers in hand.
+#Each card is a dict with its name, and how many +cards and +actions it gives when played, e.g.
+lab = {'name':'lab','cards':2,'actions':1}
+village = {'name':'village','cards':1,'actions':2}
+smithy = {'name':'smithy','cards':3,'actions':0}
+#The sims of an infinite deck take the fraction of each card as keyword arguments, e.g. fraction_village and fraction_smithy.
+#The sims of a finite deck take the deck_size and the number of each card, e.g. num_village and num_smithy.
+
+#Cards with the same +cards and +actions behave identically, so they are merged into a single card class.
+#Only neighbors in the play priority are merged, since otherwise merging would change which card gets played.
+#Returns a list of dicts with the cards and actions of each class, and the names of the cards in it, in order of priority.
+def merge_cards(cards):
+    classes = []
+    for card in cards:
+        if len(classes) > 0 and (classes[-1]['cards'],classes[-1]['actions']) == (card['cards'],card['actions']):
+            classes[-1]['names'].append(card['name'])
+        else:
+            classes.append({'cards':card['cards'],'actions':card['actions'],'names':[card['name']]})
+    return classes
+
+#Makes a Monte Carlo sim class and a Markov sim class for a deck (a list of cards, see above), of infinite or finite size.
+#deck_name is used in the sim_type, and key in the names of the classes, e.g.
+#monte_vsm_deck, markov_vsm_deck = deck_sims('Village/Smithy','vsm',[village,smithy])
+#monte_vsm_fin_deck, markov_vsm_fin_deck = deck_sims('Village/Smithy','vsm',[village,smithy],finite=True)
+#To run in worker processes (e.g. with simSweep), the classes have to be assigned to module-level names in this module,
+#as they are below, so that they can be found by name.
+def deck_sims(deck_name,key,cards,finite=False):
+    if len(cards) > 3:
+        raise ValueError("Error: expected at most 3 action cards, since sims have at most 5 parameters")
+    attributes = {'cards':cards,'card_classes':merge_cards(cards),'card_types':len(merge_cards(cards))+1,
+                  'is_finite':finite,'version':2,'__module__':__name__}
+    if finite:
+        amounts = ['num_' + card['name'] for card in cards]
+        monte_class = type('monte_' + key + '_fin_deck',(monte_deck_fin,),dict(attributes,
+            sim_type = "Monte Deck Finite: " + deck_name,
+            parameter_names = ["deck_size","stat_weight"] + amounts))
+        markov_class = type('markov_' + key + '_fin_deck',(markov_deck_fin,),dict(attributes,
+            sim_type = "Markov Deck Finite: " + deck_name,
+            parameter_names = ["deck_size"] + amounts))
+    else:
+        amounts = ['fraction_' + card['name'] for card in cards]
+        monte_class = type('monte_' + key + '_deck',(monte_deck_inf,),dict(attributes,
+            sim_type = "Monte Deck Infinite: " + deck_name,
+            parameter_names = ["max_cards","stat_weight"] + amounts))
+        markov_class = type('markov_' + key + '_deck',(markov_deck_inf,),dict(attributes,
+            sim_type = "Markov Deck Infinite: " + deck_name,
+            parameter_names = ["max_cards","max_actions"] + amounts))
+    return (monte_class,markov_class)
+
+#Reads the amount of each card (its fraction, or its number in a finite deck) from keyword arguments.
+#Returns the list of amounts in the order of sim.cards, and the amount of each card class, with copper first.
+#total is 1 for fractions, or the deck size.
+def class_amounts(sim,amounts,total):
+    prefix = 'num_' if sim.is_finite else 'fraction_'
+    names = [prefix + card['name'] for card in sim.cards]
+    if set(amounts) != set(names):
+        raise ValueError("Error: expected " + ", ".join(names))
+    if sim.is_finite and not all(isinstance(amount,int) for amount in amounts.values()):
+        raise ValueError("Error: expected integer numbers of cards")
+    if sum(amounts.values()) > total:
+        raise ValueError("Error: expected " + ("number of action cards at most the deck size" if sim.is_finite else "fraction of action cards less than 1"))
+    class_amounts = [sum(amounts[prefix + name] for name in card_class['names']) for card_class in sim.card_classes]
+    return ([amounts[name] for name in names],[total - sum(class_amounts)] + class_amounts)
+
+#Chained cards are played as soon as they are drawn, and the cards they draw don't count towards the card cap, as in the
+#village/smithy sims.  A card class is chained if it draws one card, gives at least one action, and comes before every
+#terminal card (one with no +actions) in the order of priority.  With an action left, it would be played before any terminal,
+#and playing it first doesn't change which other cards can be played.  Only cards of an infinite deck are chained, and only
+#if they aren't the whole deck (so that a run of them ends).
+#Returns a boolean array with an entry per card class, given the fraction of [coppers, each card class] in the deck.
+def chained_classes(card_classes,p_vector):
+    chained = np.zeros(len(card_classes),dtype=bool)
+    for card in range(len(card_classes)):
+        if card_classes[card]['actions'] == 0:
+            break
+        chained[card] = card_classes[card]['cards'] == 1
+    if np.sum(np.asarray(p_vector[1:])[chained]) >= 1:
+        chained[:] = False
+    return chained
+
+#######################################
+######## Compiled Monte Carlo #########
+#######################################
+
+#A Monte Carlo sim of an infinite deck described by cards.  The hand has coppers first, then one entry per card class.
+#Use deck_sims to make the subclass for a particular deck.
+class monte_deck_inf(monte_sim):
+
+    def __init__(self,max_cards=1000,num_sims=1000,**fractions):
+        (fractions,self.class_p_vector) = class_amounts(self,fractions,1)
+        self.parameters = [max_cards,num_sims] + fractions
+        self.deck_init()
+
+    #Cards drawn by chained cards (see chained_classes) don't count towards the card cap, so uncounted_cards is how many
+    #of each card's draws to take back off cards_drawn.
+    def deck_init(self):
+        self.plus_cards = np.array([0] + [card_class['cards'] for card_class in self.card_classes])
+        self.plus_actions = np.array([0] + [card_class['actions'] for card_class in self.card_classes])
+        chained = np.zeros(len(self.card_classes),dtype=bool)
+        if not self.is_finite:
+            chained = chained_classes(self.card_classes,self.class_p_vector)
+        self.uncounted_cards = np.where(np.concatenate([[False],chained]),self.plus_cards,0)
+        self.monte_init()
+
+    #p_vector is the fraction of [coppers, first card class, etc.] in deck
+    def init_p_vector(self):
+        self.p_vector = list(self.class_p_vector)
+
+    kernel = staticmethod(deck_turns)
+    def kernel_arguments(self):
+        if self.is_finite:
+            return (self.parameters[0],np.zeros(0),np.array(self.class_p_vector),True,self.plus_cards,self.plus_actions,self.uncounted_cards)
+        return (self.parameters[0],np.cumsum(self.class_p_vector[:-1]),np.zeros(0,dtype=int),False,self.plus_cards,self.plus_actions,self.uncounted_cards)
+
+    #Plays the first card in order of priority, if able
+    def action(self):
+        if self.action_supply == 0:
+            return False
+        for card in range(1,self.card_types):
+            if self.card_vector[card] >= 1:
+                self.card_vector[card] -= 1
+                self.action_supply += self.plus_actions[card] - 1
+                for i in range(self.plus_cards[card]):
+                    self.draw()
+                self.cards_drawn -= self.uncounted_cards[card]
+                return True
+        return False
+
+    #Plays the first card in order of priority in each lane that is able
+    def batch_action(self,lanes):
+        in_hand = self.lane_card_vector[lanes,1:] >= 1
+        success = (self.lane_action_supply[lanes] > 0) & np.any(in_hand,axis=1)
+        cards = np.argmax(in_hand[success],axis=1) + 1
+        lanes = lanes[success]
+        self.lane_card_vector[lanes,cards] -= 1
+        self.lane_action_supply[lanes] += self.plus_actions[cards] - 1
+        draws = self.plus_cards[cards]
+        for i in range(np.max(draws,initial=0)):
+            self.batch_draw(lanes[draws > i])
+        self.lane_cards_drawn[lanes] -= self.uncounted_cards[cards]
+        return success
+
+#A Monte Carlo sim of a finite deck described by cards.  Here the p_vector is the number of cards of each type in the deck,
+#and cards are drawn from a shuffled deck as in monte_lab_fin.
+class monte_deck_fin(monte_deck_inf):
+
+    def __init__(self,deck_size=30,num_sims=1000,**counts):
+        (counts,self.class_p_vector) = class_amounts(self,counts,deck_size)
+        self.parameters = [deck_size,num_sims] + counts
+        self.deck_init()
+
+    monte_init = monte_lab_fin.monte_init
+    draw = monte_lab_fin.draw
+    batch_init_p_vector = monte_lab_fin.batch_init_p_vector
+    batch_draw = monte_lab_fin.batch_draw
+
+#######################################
+########### Compiled Markov ###########
+#######################################
+
+#A Markov sim of an infinite deck described by cards.  Use deck_sims to make the subclass for a particular deck.
+#Only the reachable states are kept, in a sparse list.  Each state is a hand, packed into a single integer key (one digit per field),
+#so that merging states is a sort of integers, and has a dense row of the probability of each action supply, as in markov_vsm_inf.
+#Every action, each state plays one card, so all states have played the same number of cards.
+#
+#Chained cards (see chained_classes, e.g. village) are played as soon as they're drawn, as markov_vsm_inf does with villages.
+#So a draw is a run of chained cards, which adds to the action supply, followed by an unchained card.
+#Chained cards drawn with no actions left can't be played, and are counted with the last terminal card (which doesn't matter,
+#since the turn is over).  The key has the number of each unchained card in hand.  If they all draw the same number of cards,
+#every state has the same hand size, so the coppers in hand follow from the key, and otherwise the key also counts coppers.
+#So e.g. a lab deck has a single field, and a village/smithy deck is (smithies in hand, action supply), as in the hand-written sims.
+#As in markov_vsm_inf, the card cap counts the first five cards and the cards drawn by unchained cards.
+#The action supply is capped at max_actions.  If no card gives more than one +action, the action supply is only 0 or 1.
+#States with probability less than prune_epsilon are discarded, and counted in discarded_mass (which is counted towards reliability).
+class markov_deck_inf(markov_sim):
+    prune_epsilon = 1e-14
+
+    #The default prune_epsilon is part of how this sim is defined, so only a different one makes the results approximate
+    exact_settings = dict(markov_sim.exact_settings,prune_epsilon=1e-14)
+
+    def __init__(self,max_cards=1000,max_actions=40,**fractions):
+        (fractions,self.class_p_vector) = class_amounts(self,fractions,1)
+        self.parameters = [max_cards,max_actions] + fractions
+
+    def init_prob(self):
+        self.p_vector = np.array(self.class_p_vector,dtype=float)
+        self.plus_cards = np.array([card_class['cards'] for card_class in self.card_classes])
+        self.plus_actions = np.array([card_class['actions'] for card_class in self.card_classes])
+        self.card_cap = self.parameters[0]
+        self.num_supply = self.parameters[1] if np.max(self.plus_actions) > 1 else 2
+
+        #The fields of a key are [number of each unchained card class, coppers (unless the hand size is the same in every state)].
+        #Hands can go over max_cards by one action's draws.
+        num_classes = len(self.card_classes)
+        chained = chained_classes(self.card_classes,self.p_vector)
+        unchained = np.flatnonzero(~chained)
+        self.uniform_hand = len(set(self.plus_cards[unchained])) <= 1
+        max_hand = self.parameters[0] + np.max(self.plus_cards) + 5
+        self.init_keys([max_hand+1]*(len(unchained) + (0 if self.uniform_hand else 1)))
+        self.class_fields = np.full(num_classes,-1)
+        self.class_fields[unchained] = np.arange(len(unchained))
+        self.copper_field = -1 if self.uniform_hand else len(unchained)
+        self.play_steps = np.array([-self.weights[field] if field >= 0 else 0 for field in self.class_fields],dtype=np.int64)
+        self.init_play_matrices()
+
+        #Each card that can end a draw, with the change to the key and its probability for each action supply
+        p_chained = np.sum(self.p_vector[1:][chained])
+        self.chain_matrix = self.supply_chain(chained,p_chained) if np.any(chained) else None
+        terminals = np.flatnonzero(self.plus_actions == 0)
+        self.draw_offsets = []
+        self.draw_multipliers = []
+        for card in range(num_classes+1):
+            multiplier = np.full(self.num_supply,self.p_vector[card]/(1-p_chained))
+            multiplier[0] = self.p_vector[card]
+            if card == 0:
+                offset = 0 if self.uniform_hand else self.weights[self.copper_field]
+            elif chained[card-1]:
+                if len(terminals) == 0:
+                    continue #there's always an action left to play it
+                offset = self.weights[self.class_fields[terminals[-1]]]
+                multiplier[1:] = 0
+            else:
+                offset = self.weights[self.class_fields[card-1]]
+            if self.p_vector[card] > 0:
+                self.draw_offsets.append(offset)
+                self.draw_multipliers.append(multiplier)
+
+    #Sets the radix and weight of each field of the keys
+    def init_keys(self,radix):
+        self.radix = np.array(radix,dtype=np.int64)
+        if np.prod(self.radix.astype(float)) >= 2.0**63:
+            raise ValueError("Error: too many states to pack into integer keys")
+        self.weights = np.cumprod(np.concatenate([[1],self.radix]))[:len(self.radix)]
+
+    #play_matrices[card] moves the probability of each action supply to the supply after playing card.
+    #Nothing can be played with no actions left, so that row is empty.
+    def init_play_matrices(self):
+        supply = np.arange(1,self.num_supply)
+        self.play_matrices = []
+        for card in range(len(self.card_classes)):
+            play_matrix = np.zeros((self.num_supply,self.num_supply))
+            play_matrix[supply,np.minimum(supply - 1 + self.plus_actions[card],self.num_supply - 1)] = 1
+            self.play_matrices.append(play_matrix)
+
+    #Returns the matrix that moves the probability of each action supply to the supply after a run of chained cards.
+    #Each chained card adds actions-1 to the supply, and the run ends with the first unchained card, so the gain is
+    #a sum of a geometric number of gains.  Its distribution is (1-p_chained)/(1-Q(z)) as a power series, where
+    #Q(z) sums p*z**(actions-1) over the chained classes.  With no actions left, chained cards can't be played, so that row stays put.
+    #The supply is capped at num_supply-1.
+    def supply_chain(self,chained,p_chained):
+        num_supply = self.num_supply
+        gains = np.zeros(num_supply)
+        for card in np.flatnonzero(chained):
+            gains[min(self.plus_actions[card]-1,num_supply-1)] += self.p_vector[card+1]
+        series = np.zeros(num_supply)
+        for gain in range(num_supply):
+            series[gain] = ((gain == 0) + np.dot(gains[1:gain+1],series[gain-1::-1][:gain])) / (1-gains[0])
+        p_gain = (1-p_chained)*series
+        chain_matrix = np.zeros((num_supply,num_supply))
+        chain_matrix[0,0] = 1
+        for supply in range(1,num_supply):
+            chain_matrix[supply,supply:-1] = p_gain[:num_supply-1-supply]
+            chain_matrix[supply,-1] = 1 - np.sum(p_gain[:num_supply-1-supply])
+        return chain_matrix
+
+    #Unpacks a field of the keys
+    def key_field(self,keys,field):
+        return keys // self.weights[field] % self.radix[field]
+
+    #Returns the number of each card class in hand, and the number of coppers
+    def hand(self,keys):
+        hand = np.zeros((len(keys),len(self.card_classes)),dtype=np.int64)
+        for card in np.flatnonzero(self.class_fields >= 0):
+            hand[:,card] = self.key_field(keys,self.class_fields[card])
+        if self.uniform_hand:
+            coppers = self.hand_size - np.sum(hand,axis=1)
+        else:
+            coppers = self.key_field(keys,self.copper_field)
+        return (hand,coppers)
+
+    #Merges blocks of states (a list of (keys,probs), with no key repeated within a block), summing the probability of
+    #identical keys, and discards improbable states.  Since keys are unique within a block, each block is added in one go.
+    def merge_states(self,blocks):
+        (keys,inverse) = np.unique(np.concatenate([block_keys for block_keys,block_probs in blocks]),return_inverse=True)
+        probs = np.zeros((len(keys),self.num_supply))
+        start = 0
+        for block_keys,block_probs in blocks:
+            probs[inverse[start:start+len(block_keys)]] += block_probs
+            start += len(block_keys)
+        totals = np.sum(probs,axis=1)
+        keep = (totals > 0) & (totals >= self.prune_epsilon)
+        self.discarded_mass += np.sum(totals[~keep])
+        return (keys[keep],probs[keep])
+
+    #Returns the change to the key and the probability (which broadcasts against probs) of each card that can be drawn,
+    #and which states have an empty deck, and draw nothing.
+    def draw_outcomes(self,keys):
+        return (self.draw_offsets,self.draw_multipliers,np.zeros(len(keys),dtype=bool))
+
+    #Draws num_draws cards in each state
+    def draw_states(self,keys,probs,num_draws):
+        for i in range(num_draws):
+            if self.chain_matrix is not None:
+                probs = np.matmul(probs,self.chain_matrix)
+            (offsets,multipliers,empty) = self.draw_outcomes(keys)
+            blocks = [(keys + offset,probs*multiplier) for offset,multiplier in zip(offsets,multipliers)]
+            (keys,probs) = self.merge_states(blocks + [(keys[empty],probs[empty])])
+        return (keys,probs)
+
+    def live_mass(self):
+        return self.live_probability
+
+    #Draws 5 cards, and then every state plays one card per step, until every state has failed or reached the card cap.
+    #The payoff_vector and snapshots (see markov_sim.checkpoints) are as in markov_sim.turn.
+    def turn(self):
+        self.batch_shape = self.get_batch_shape()
+        self.init_prob()
+        max_cards = self.parameters[0]
+        self.payoff_vector = np.zeros(max_cards+1)
+        self.snapshots = {cap:np.zeros(cap+1) for cap in self.checkpoints}
+        self.discarded_mass = 0
+        self.num_cards = max_cards #so that record_history uses the whole payoff_vector
+        self.history = []
+
+        self.hand_size = 5
+        start = np.zeros((1,self.num_supply))
+        start[0,1] = 1
+        (keys,probs) = self.draw_states(np.zeros(1,dtype=np.int64),start,5)
+        self.num_steps = 0
+        while len(keys) > 0:
+            #states that have reached the card cap are dropped, and counted towards reliability
+            (hand,coppers) = self.hand(keys)
+            num_cards = np.sum(hand,axis=1) + coppers + self.num_steps
+            live = num_cards < self.card_cap
+            (keys,probs,hand,coppers,num_cards) = (keys[live],probs[live],hand[live],coppers[live],num_cards[live])
+            state_probs = np.sum(probs,axis=1)
+            self.live_probability = np.sum(state_probs)
+            if self.extrapolate:
+                self.record_history()
+            if self.tolerance > 0 and self.live_probability < self.tolerance:
+                break
+
+            #states that can't play a card, or have no actions left, fail with a payoff of the coppers in hand
+            in_hand = hand >= 1
+            success = np.any(in_hand,axis=1)
+            failed = np.where(success,probs[:,0],state_probs)
+            self.payoff_vector += np.bincount(coppers,failed,minlength=max_cards+1)
+            for cap in self.checkpoints:
+                capped = np.where(num_cards < cap,failed,0)
+                self.snapshots[cap] += np.bincount(coppers,capped,minlength=max_cards+1)[:cap+1]
+
+            #each remaining state plays its first card in order of priority, and then draws
+            (keys,probs,cards) = (keys[success],probs[success],np.argmax(in_hand[success],axis=1))
+            drawn = []
+            for card in np.unique(cards):
+                chosen = cards == card
+                played = np.matmul(probs[chosen],self.play_matrices[card])
+                drawn.append(self.draw_states(keys[chosen] + self.play_steps[card],played,self.plus_cards[card]))
+            if len(drawn) == 0:
+                break
+            (keys,probs) = self.merge_states(drawn)
+            self.hand_size += self.plus_cards[cards[0]] - 1 #only used if this is the same for every card
+            self.num_steps += 1
+        return self.payoff_vector
+
+    #The number of distinct states is not known in advance, so the state size is the card cap, as in markov_sim
+    def state_size(self):
+        return self.parameters[0]
+
+#A Markov sim of a finite deck described by cards.  Nothing is chained, and the keys count the coppers in hand, and also the cards
+#of each class that have been played, so that the composition of the remaining deck follows from the state.  Every field is at most
+#the deck size, so the number of reachable states is bounded, and nothing is pruned.  There is no card cap: the turn goes on until
+#every state fails, and states that have drawn the whole deck keep playing the cards in hand.
+class markov_deck_fin(markov_deck_inf):
+    prune_epsilon = 0
+    exact_settings = dict(markov_sim.exact_settings,prune_epsilon=0)
+
+    def __init__(self,deck_size=30,**counts):
+        (counts,self.class_p_vector) = class_amounts(self,counts,deck_size)
+        self.parameters = [deck_size] + counts
+
+    #p_vector is the number of [coppers, first card class, etc.] in the starting deck
+    def init_prob(self):
+        self.p_vector = np.array(self.class_p_vector)
+        self.plus_cards = np.array([card_class['cards'] for card_class in self.card_classes])
+        self.plus_actions = np.array([card_class['actions'] for card_class in self.card_classes])
+        self.card_cap = np.inf
+        #The action supply can't go over 1 plus the extra actions of every card in the deck.
+        self.num_supply = 2 + int(np.sum(self.p_vector[1:]*np.maximum(self.plus_actions-1,0)))
+
+        #The fields of a key are [number of each card class in hand, coppers in hand, number of each card class played].
+        num_classes = len(self.card_classes)
+        self.init_keys([self.parameters[0]+1]*(2*num_classes+1))
+        self.uniform_hand = False
+        self.class_fields = np.arange(num_classes)
+        self.copper_field = num_classes
+        #playing a card moves it from the hand to the played cards
+        self.play_steps = self.weights[num_classes+1:] - self.weights[:num_classes]
+        self.init_play_matrices()
+        self.chain_matrix = None
+        self.draw_offsets = [self.weights[self.copper_field]] + list(self.weights[:num_classes])
+
+    def draw_outcomes(self,keys):
+        num_classes = len(self.card_classes)
+        remaining = np.empty((len(keys),num_classes+1))
+        remaining[:,0] = self.p_vector[0] - self.key_field(keys,self.copper_field)
+        for card in range(num_classes):
+            remaining[:,card+1] = self.p_vector[card+1] - self.key_field(keys,card) - self.key_field(keys,num_classes+1+card)
+        cards_in_deck = np.sum(remaining,axis=1,keepdims=True)
+        multipliers = remaining / np.maximum(cards_in_deck,1)
+        return (self.draw_offsets,[multipliers[:,card:card+1] for card in range(num_classes+1)],cards_in_deck[:,0] == 0)
+
+#######################################
+############ Standard decks ###########
+#######################################
+
+#The decks of the hand-written sims in dominionMarkov, which the compiled sims can be checked against.
+(monte_lab_deck,markov_lab_deck) = deck_sims('Lab','lab',[lab])
+(monte_vsm_deck,markov_vsm_deck) = deck_sims('Village/Smithy','vsm',[village,smithy])
+(monte_lab_fin_deck,markov_lab_fin_deck) = deck_sims('Lab','lab',[lab],finite=True)
+#Decks that have no hand-written sim
+(monte_vsm_fin_deck,markov_vsm_fin_deck) = deck_sims('Village/Smithy','vsm',[village,smithy],finite=True)
+(monte_vls_deck,markov_vls_deck) = deck_sims('Village/Lab/Smithy','vls',[village,lab,smithy])
+
+#Runs the Monte Carlo and Markov sims of the same deck at the same point (keyword arguments shared by both constructors),
+#without using the database.  Returns the Markov (mean,stdev,reliability), the Monte Carlo (mean,stdev,reliability),
+#and how many standard errors the Monte Carlo mean and reliability are from the Markov ones.
+def cross_check(monte_class,markov_class,num_sims=100000,seed=0,**point):
+    markov = markov_class(**point)
+    markov.testing = True
+    markov_results = markov.sim(force=True)
+    monte = monte_class(num_sims=num_sims,**point)
+    monte.testing = True
+    monte_results = monte.sim(force=True,seed=seed)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        z_mean = (monte_results[0] - markov_results[0]) / ((monte.mean_ci[1] - monte.mean_ci[0])/(2*monte.confidence))
+        z_reliability = (monte_results[2] - markov_results[2]) / (markov_results[2]*(1-markov_results[2])/monte.turns_used) ** 0.5
+    return (markov_results,monte_results,(z_mean,z_reliability))
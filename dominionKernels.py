@@ -0,0 +1,257 @@
+'''
+Dominion Markov
+Author: Tristan Miller
+This contains turn kernels for the Monte Carlo sims, which are compiled with numba if it's installed
+'''
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+#A turn kernel simulates one turn at a time, with plain loops instead of numpy arrays of lanes, so it can be compiled.
+#Each kernel takes a matrix of uniform random numbers, with a row per turn, and the sim's parameters.  Every draw (or check of
+#the top card) uses the next number in the turn's row, and finite decks are shuffled with the first numbers of the row,
+#in the same order as the batched engine of monte_sim uses them.
+#So with common random numbers, a kernel gives exactly the same turns as the batched engine.
+#Kernels return the payoff of each turn (np.inf at the card cap), and how many numbers each turn used.  A turn that needed more
+#numbers than its row had is garbage (it used 0 for the missing numbers), and has to be run again with a longer row.
+#
+#If numba is installed, the kernels are compiled, and compiled_backend is 'numba'.  Otherwise they're plain python,
+#which is several times slower than the batched engine, and only useful for checking it.
+#Either way, the plain python version of a kernel is python_kernel(kernel).
+if numba is not None:
+    compile_kernel = numba.njit(cache=True)
+    compiled_backend = 'numba'
+else:
+    def compile_kernel(function):
+        return function
+    compiled_backend = 'python'
+
+def python_kernel(kernel):
+    return getattr(kernel,'py_func',kernel)
+
+#Returns the numbers used so far plus one, and the next number in the row (or 0 if there are none left)
+@compile_kernel
+def next_uniform(row,used):
+    if used < len(row):
+        return (used+1,row[used])
+    return (used+1,0.)
+
+#Picks a card type from an infinite deck, like np.searchsorted(p_cumulative,u,side='right')
+@compile_kernel
+def infinite_card(p_cumulative,u):
+    card = 0
+    while card < len(p_cumulative) and u >= p_cumulative[card]:
+        card += 1
+    return card
+
+#Shuffles a finite deck with pile[i] cards of type i, like shuffled_deck in dominionMarkov: the order is the sort order
+#of the first numbers in the row, one per card.  The row has to have at least as many numbers as cards.
+@compile_kernel
+def shuffled_cards(pile,row):
+    deck_size = 0
+    for count in pile:
+        deck_size += count
+    cards = np.empty(deck_size,dtype=np.int64)
+    k = 0
+    for card in range(len(pile)):
+        for i in range(pile[card]):
+            cards[k] = card
+            k += 1
+    return cards[np.argsort(row[:deck_size])]
+
+#monte_lab_inf
+@compile_kernel
+def lab_inf_turns(uniforms,max_cards,p_cumulative):
+    num_turns = uniforms.shape[0]
+    payoff = np.empty(num_turns)
+    used = np.zeros(num_turns,dtype=np.int64)
+    for turn in range(num_turns):
+        row = uniforms[turn]
+        hand = np.zeros(2,dtype=np.int64)
+        cards_drawn = 0
+        n = 0
+        for i in range(5):
+            (n,u) = next_uniform(row,n)
+            hand[infinite_card(p_cumulative,u)] += 1
+            cards_drawn += 1
+        action_check = True
+        while action_check and cards_drawn < max_cards:
+            if hand[1] >= 1:
+                hand[1] -= 1
+                for i in range(2):
+                    (n,u) = next_uniform(row,n)
+                    hand[infinite_card(p_cumulative,u)] += 1
+                    cards_drawn += 1
+            else:
+                action_check = False
+        payoff[turn] = np.inf if action_check else hand[0]
+        used[turn] = n
+    return (payoff,used)
+
+#monte_lab_fin.  pile is the number of [coppers,labs] in the deck, which is shuffled with the first numbers of the row.
+@compile_kernel
+def lab_fin_turns(uniforms,pile):
+    num_turns = uniforms.shape[0]
+    payoff = np.empty(num_turns)
+    used = np.zeros(num_turns,dtype=np.int64)
+    deck_size = np.sum(pile)
+    for turn in range(num_turns):
+        row = uniforms[turn]
+        used[turn] = deck_size
+        if deck_size > len(row):
+            payoff[turn] = 0
+            continue
+        deck = shuffled_cards(pile,row)
+        position = 0
+        hand = np.zeros(2,dtype=np.int64)
+        draws = 5
+        while draws > 0:
+            for i in range(draws):
+                if position < deck_size:
+                    hand[deck[position]] += 1
+                    position += 1
+            draws = 0
+            if hand[1] >= 1:
+                hand[1] -= 1
+                draws = 2
+        payoff[turn] = hand[0]
+    return (payoff,used)
+
+#monte_vsm_inf
+@compile_kernel
+def vsm_inf_turns(uniforms,max_cards,p_cumulative):
+    num_turns = uniforms.shape[0]
+    payoff = np.empty(num_turns)
+    used = np.zeros(num_turns,dtype=np.int64)
+    for turn in range(num_turns):
+        row = uniforms[turn]
+        hand = np.zeros(3,dtype=np.int64)
+        cards_drawn = 0
+        action_supply = 1
+        n = 0
+        for i in range(5):
+            (n,u) = next_uniform(row,n)
+            hand[infinite_card(p_cumulative,u)] += 1
+            cards_drawn += 1
+        action_check = True
+        while action_check and cards_drawn < max_cards:
+            if action_supply > 0 and hand[1] >= 1:
+                #play a village
+                hand[1] -= 1
+                (n,u) = next_uniform(row,n)
+                hand[infinite_card(p_cumulative,u)] += 1
+                cards_drawn += 1
+                action_supply += 1
+            elif action_supply > 0 and hand[2] >= 1:
+                #play a smithy
+                hand[2] -= 1
+                for i in range(3):
+                    (n,u) = next_uniform(row,n)
+                    hand[infinite_card(p_cumulative,u)] += 1
+                    cards_drawn += 1
+                action_supply -= 1
+            else:
+                action_check = False
+        payoff[turn] = np.inf if action_check else hand[0]
+        used[turn] = n
+    return (payoff,used)
+
+#monte_herald_inf.  The top card is checked first, and again after every draw.
+@compile_kernel
+def herald_inf_turns(uniforms,max_cards,p_cumulative):
+    num_turns = uniforms.shape[0]
+    payoff = np.empty(num_turns)
+    used = np.zeros(num_turns,dtype=np.int64)
+    for turn in range(num_turns):
+        row = uniforms[turn]
+        hand = np.zeros(2,dtype=np.int64)
+        cards_drawn = 0
+        n = 0
+        (n,u) = next_uniform(row,n)
+        top = infinite_card(p_cumulative,u)
+        for i in range(5):
+            hand[top] += 1
+            (n,u) = next_uniform(row,n)
+            top = infinite_card(p_cumulative,u)
+            cards_drawn += 1
+        action_check = True
+        while action_check and cards_drawn < max_cards:
+            if hand[1] >= 1:
+                hand[1] -= 1
+                hand[top] += 1
+                (n,u) = next_uniform(row,n)
+                top = infinite_card(p_cumulative,u)
+                cards_drawn += 1
+                if top == 1:
+                    #If top card is a herald, draw again
+                    hand[top] += 1
+                    (n,u) = next_uniform(row,n)
+                    top = infinite_card(p_cumulative,u)
+                    cards_drawn += 1
+            else:
+                action_check = False
+        payoff[turn] = np.inf if action_check else hand[0]
+        used[turn] = n
+    return (payoff,used)
+
+#The compiled decks of dominionCards.  The hand is [coppers, card classes in order of priority].
+#For an infinite deck, p_cumulative is the cumulative fraction of each type.  For a finite deck (finite is True), pile is the
+#number of each type in the deck, which is shuffled as in lab_fin_turns, and there is no card cap.
+#uncounted_cards is how many of each card's draws don't count towards the card cap (see chained_classes in dominionCards).
+@compile_kernel
+def deck_turns(uniforms,max_cards,p_cumulative,pile,finite,plus_cards,plus_actions,uncounted_cards):
+    num_turns = uniforms.shape[0]
+    payoff = np.empty(num_turns)
+    used = np.zeros(num_turns,dtype=np.int64)
+    card_types = len(plus_cards)
+    deck_size = np.sum(pile)
+    for turn in range(num_turns):
+        row = uniforms[turn]
+        n = 0
+        if finite:
+            n = deck_size
+            if deck_size > len(row):
+                used[turn] = n
+                payoff[turn] = 0
+                continue
+        deck = shuffled_cards(pile,row) #empty for an infinite deck
+        position = 0
+        hand = np.zeros(card_types,dtype=np.int64)
+        cards_drawn = 0
+        action_supply = 1
+        draws = 5
+        uncounted = 0
+        action_check = True
+        while True:
+            for i in range(draws):
+                if finite:
+                    if position < deck_size:
+                        hand[deck[position]] += 1
+                        position += 1
+                else:
+                    (n,u) = next_uniform(row,n)
+                    hand[infinite_card(p_cumulative,u)] += 1
+                    cards_drawn += 1
+            cards_drawn -= uncounted
+            if not (action_check and (finite or cards_drawn < max_cards)):
+                break
+            #play the first card in order of priority
+            played = -1
+            if action_supply > 0:
+                for card in range(1,card_types):
+                    if hand[card] >= 1:
+                        played = card
+                        break
+            if played < 0:
+                action_check = False
+                draws = 0
+            else:
+                hand[played] -= 1
+                action_supply += plus_actions[played] - 1
+                draws = plus_cards[played]
+                uncounted = uncounted_cards[played]
+        payoff[turn] = np.inf if action_check and not finite else hand[0]
+        used[turn] = n
+    return (payoff,used)
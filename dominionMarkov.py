@@ -12,6 +12,12 @@ from numpy import random
 import time
 #import sys
 #import re
+import os
+import atexit
+import copy
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dominionKernels import python_kernel, lab_inf_turns, lab_fin_turns, vsm_inf_turns, herald_inf_turns
 import sqlite3 as lite
 
 #######################################
@@ -57,8 +63,147 @@ def init_sql_database():
             reliability real,
             deleted bit)'''
         cur.execute(sqlcmd)
+    init_sql_indexes(con)
+    init_sql_distributions(con)
     con.close()
 
+#Creates the indexes used to look up results, if they don't already exist
+def init_sql_indexes(con):
+    with con:
+        #Used to find previous results of an identical simulation
+        con.execute('''
+            create index if not exists sim_results_lookup
+                on sim_results(sim_type_id, sim_version, deleted, p0, p1, p2, p3, p4)''')
+        #Used to load results for figures, which select by max_cards and bin by the remaining parameters
+        con.execute('''
+            create index if not exists sim_results_figures
+                on sim_results(sim_type_id, deleted, p0, p2, p3)''')
+
+#Creates the table of payoff distributions, if it doesn't already exist.
+#Each row is the full payoff distribution of one row of sim_results (so far only Markov sims store them).
+#data is the probability of each payoff (0, 1, 2...) as float32, with trailing zeros removed, compressed with zlib.
+#length is the number of payoffs stored.
+def init_sql_distributions(con):
+    with con:
+        con.execute('''
+            create table if not exists sim_distributions(
+                result_id integer primary key references sim_results(id),
+                length integer,
+                data blob)''')
+
+#Converts a payoff distribution to and from the format stored in sim_distributions
+def encode_distribution(distribution):
+    distribution = np.asarray(distribution,dtype=np.float32)
+    nonzero = np.flatnonzero(distribution)
+    distribution = distribution[:nonzero[-1]+1] if len(nonzero) > 0 else distribution[:0]
+    return (len(distribution),zlib.compress(distribution.tobytes()))
+
+#The array is read-only, and shares memory with the decompressed data
+def decode_distribution(data):
+    return np.frombuffer(zlib.decompress(data),dtype=np.float32)
+
+#Writes simulation results to the database, keeping one connection open instead of connecting for every result.
+#Results are queued, and written together once flush_size results are waiting, or flush_interval seconds have passed since the last write.
+#The database is put in WAL mode, so that several processes can append results at the same time.
+class result_sink:
+    
+    def __init__(self,db_name='sim.db',flush_size=1,flush_interval=0):
+        self.db_name = db_name
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.con = None
+        self.pid = None #process that opened the connection.  A forked worker process needs its own connection.
+        self.queue = [] #rows waiting to be written, each with its encoded distribution (or None)
+        self.sim_type_ids = {} #cached sim_types id for each sim_type name
+        self.last_flush = time.time()
+        atexit.register(self.close)
+    
+    def connect(self):
+        if self.con is None or self.pid != os.getpid():
+            self.con = lite.connect(self.db_name,timeout=60)
+            self.con.execute('pragma journal_mode=wal')
+            self.con.execute('pragma synchronous=normal')
+            init_sql_indexes(self.con)
+            init_sql_distributions(self.con)
+            self.pid = os.getpid()
+            self.queue = []
+        return self.con
+    
+    #Returns the id of the simulation type, adding it to sim_types if it isn't already in the database
+    def sim_type_id(self,sim):
+        result_type = sim.result_type()
+        if result_type not in self.sim_type_ids:
+            con = self.connect()
+            with con:
+                ps_string = ''.join(['p' + str(i) + '_name, ' for i in range(len(sim.parameters))])
+                sqlcmd = 'insert or ignore into sim_types(name, ' + ps_string + 'card_types) values(' + '?, '*(len(sim.parameters)+1) + '?)'
+                con.execute(sqlcmd,[result_type] + list(sim.parameter_names[:len(sim.parameters)]) + [sim.card_types])
+                self.sim_type_ids[result_type] = con.execute('select id from sim_types where name = ?',(result_type,)).fetchone()[0]
+        return self.sim_type_ids[result_type]
+    
+    #Returns the most recent stored (mean,stdev,reliability) of an identical simulation, or None if there isn't one.
+    #Like sim(), mean and stdev are nan if there are no finite payoffs.
+    def lookup(self,sim):
+        self.flush()
+        con = self.connect()
+        row = con.execute('select id from sim_types where name = ?',(sim.result_type(),)).fetchone()
+        if row is None:
+            return None
+        conditions = ''
+        for i in range(5):
+            if i < len(sim.parameters):
+                conditions += ' and p' + str(i) + ' = ?'
+            else:
+                conditions += ' and p' + str(i) + ' is null'
+        sqlcmd = '''
+            select mean, stdev, reliability from sim_results
+                where sim_type_id = ? and sim_version = ? and deleted = 0''' + conditions + '''
+                order by id desc limit 1'''
+        result = con.execute(sqlcmd,[row[0],sim.version] + [float(p) for p in sim.parameters]).fetchone()
+        if result is None:
+            return None
+        elif result[2] is None:
+            return (np.nan,np.nan,np.nan) #sqlite stores nan as null
+        elif result[2] >= 1:
+            return (np.nan,np.nan,result[2])
+        else:
+            return result
+    
+    #Queues the results of a simulation to be written.  distribution is an optional array of the probability of each payoff.
+    def add(self,sim,mean,stdev,reliability,distribution=None):
+        self.connect()
+        parameters = [float(p) for p in sim.parameters] + [None]*(5-len(sim.parameters))
+        row = [self.sim_type_id(sim),sim.version] + parameters + [float(stdev),float(mean),float(reliability)]
+        self.queue.append((row,None if distribution is None else encode_distribution(distribution)))
+        if len(self.queue) >= self.flush_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+    
+    #Writes all queued results
+    def flush(self):
+        if len(self.queue) > 0:
+            con = self.connect()
+            with con:
+                sqlcmd = '''
+                insert into sim_results(sim_type_id, sim_version, p0, p1, p2, p3, p4, stdev, mean, reliability, deleted)
+                    values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)'''
+                if all(distribution is None for row,distribution in self.queue):
+                    con.executemany(sqlcmd,[row for row,distribution in self.queue])
+                else:
+                    #rows with distributions need their id, so they're inserted one at a time
+                    for row,distribution in self.queue:
+                        result_id = con.execute(sqlcmd,row).lastrowid
+                        if distribution is not None:
+                            con.execute('insert into sim_distributions(result_id, length, data) values(?, ?, ?)',
+                                        (result_id,) + distribution)
+            self.queue = []
+        self.last_flush = time.time()
+    
+    def close(self):
+        if self.con is not None and self.pid == os.getpid():
+            self.flush()
+            self.con.close()
+        self.con = None
+
 #######################################
 ######## Abstract dom_sim class #######
 #######################################
@@ -72,6 +217,7 @@ class dom_sim:
     #is_finite = <True/False>
     #version = <#> 
     testing = False
+    sink = result_sink() #where results are written.  Replace with e.g. result_sink(flush_size=100,flush_interval=10) to write in batches
     
     #def __init__(self,<etc.>):
     
@@ -91,10 +237,29 @@ class dom_sim:
     
     #Runs the simulation (possibly simulating many turns) and returns statistics, which are written to the database
     #mean and stdev are statistics only on turns with *finite* payoff, and reliability is the probability of infinite payoff
-    #def sim(self):
+    #def simulate(self):
         #self.write_to_sql(mean,stdev,reliability)
         #return (mean,stdev,reliability)
     
+    #Counts how often sim() found its results already in the database.  Shared by all sims.
+    cache_stats = {'hits':0,'misses':0}
+    
+    #The name that results are stored under in sim_types.  By default this is the sim_type, but sims with approximations
+    #turned on store their results under a different name (see markov_sim.exact_settings).
+    def result_type(self):
+        return self.sim_type
+    
+    #Runs the simulation, unless an identical one (same sim_type, version and parameters, not deleted) is already in the database.
+    #In that case the stored results are returned instead.  force=True always runs the simulation.
+    def sim(self,force=False):
+        if not (force or self.testing):
+            results = self.sink.lookup(self)
+            if results is not None:
+                self.cache_stats['hits'] += 1
+                return results
+            self.cache_stats['misses'] += 1
+        return self.simulate()
+    
     #Runs a test simulation.  Prints out computing time and doesn't write to database
     def test_sim(self):
         self.testing = True
@@ -104,45 +269,137 @@ class dom_sim:
         self.testing = False
         return (processing_time, results)
     
-    #Writes the results to the database
-    def write_to_sql(self,mean,stdev,reliability):
+    #Writes the results to the database, optionally with the distribution of payoffs
+    def write_to_sql(self,mean,stdev,reliability,distribution=None):
         if self.testing:
             return
-        con = lite.connect('sim.db')
-        with con:
-            cur = con.cursor()
-            #If this simulation type isn't already in the database, add it.
-            sqlcmd = '''
-            insert or ignore into sim_types(name, {parameter_string}card_types)
-                values("{name}", {parameter_names}{card_types})'''
-            ps_string = ''
-            pn_string = ''
-            for i in range(len(self.parameters)):
-                ps_string += 'p' + str(i) + '_name, '
-                pn_string += '"' + self.parameter_names[i] + '", '
-            sqlcmd = sqlcmd.format(parameter_string=ps_string, name=self.sim_type, parameter_names = pn_string, card_types=self.card_types)
-            cur.execute(sqlcmd)
-            
-            #Insert the results of the simulation
-            sqlcmd = '''
-            insert into sim_results(sim_type_id, sim_version,{parameters}stdev, mean, reliability, deleted)
-                values((select id from sim_types where name = "{name}"), {version}, 
-                {parameter_values}{stdev}, {mean}, {reliability}, 0)'''
-            p_string = ''
-            pv_string = ''
-            for i in range(len(self.parameters)):
-                p_string += "p" + str(i) + ", "
-                pv_string += str(self.parameters[i]) + ", "
-            sqlcmd = sqlcmd.format(version=self.version,parameters=p_string, name=self.sim_type, parameter_values=pv_string, stdev=stdev, mean=mean, reliability=reliability)
-            #print(sqlcmd)
-            cur.execute(sqlcmd)
-        con.close()
+        self.sink.add(self,mean,stdev,reliability,distribution)
+    
+    #Profiling.  enable_profiling() counts the calls and time spent in each of these methods (the ones the sim has).
+    #It works by switching the sim to a subclass whose methods are timed, so sims that aren't profiled have no overhead.
+    #Copies of a profiled sim (e.g. the chunks of a batch) add to the same counts, but sims sent to worker processes
+    #(monte_sim chunks with workers > 1) are not profiled.
+    profiled_phases = ['simulate','turn','batch_turn','draw','batch_draw','action','batch_action','init_prob',
+                       'calc_draw_matrix','absorb','prune','write_results','write_to_sql']
+    
+    def enable_profiling(self):
+        self.profile = {}
+        self.profile_stack = [] #time spent in nested phases, for each phase currently running
+        self.__class__ = profiled_class(unprofiled_class(type(self)))
+    
+    def disable_profiling(self):
+        self.__class__ = unprofiled_class(type(self))
+    
+    #Returns a dict with the sim_type, parameters, and for each phase that was called, the number of calls,
+    #the total time, and the self time (not counting time spent in other profiled phases called from it)
+    def profile_report(self):
+        return {'sim_type':self.sim_type,
+                'parameters':[np.asarray(p).tolist() for p in self.parameters],
+                'phases':{phase:dict(stats) for phase,stats in self.profile.items()}}
+
+#Profiled subclasses of each sim class
+profiled_classes = {}
+
+def unprofiled_class(sim_class):
+    return getattr(sim_class,'unprofiled',sim_class)
+
+def profiled_class(sim_class):
+    if sim_class not in profiled_classes:
+        methods = {'unprofiled':sim_class,'__copy__':copy_profiled,'__reduce_ex__':reduce_unprofiled}
+        for phase in sim_class.profiled_phases:
+            if hasattr(sim_class,phase):
+                methods[phase] = profile_wrapper(phase,getattr(sim_class,phase))
+        profiled_classes[sim_class] = type(sim_class.__name__,(sim_class,),methods)
+    return profiled_classes[sim_class]
+
+def profile_wrapper(phase,method):
+    def profiled_method(self,*args,**kwargs):
+        start_time = time.perf_counter()
+        self.profile_stack.append(0)
+        try:
+            return method(self,*args,**kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            nested = self.profile_stack.pop()
+            if len(self.profile_stack) > 0:
+                self.profile_stack[-1] += elapsed
+            stats = self.profile.setdefault(phase,{'calls':0,'time':0,'self_time':0})
+            stats['calls'] += 1
+            stats['time'] += elapsed
+            stats['self_time'] += elapsed - nested
+    return profiled_method
+
+#Shallow copies stay profiled, and share the counts
+def copy_profiled(self):
+    duplicate = object.__new__(type(self))
+    duplicate.__dict__.update(self.__dict__)
+    return duplicate
+
+#Pickled sims (e.g. sent to worker processes) arrive unprofiled, as their original class
+def reduce_unprofiled(self,protocol):
+    state = {key:value for key,value in self.__dict__.items() if key not in ['profile','profile_stack']}
+    return (restore_sim,(unprofiled_class(type(self)),state))
+
+def restore_sim(sim_class,state):
+    sim = object.__new__(sim_class)
+    sim.__dict__.update(state)
+    return sim
+
+#Adds up a list of profile reports (e.g. from a sweep), for each sim_type and phase
+def aggregate_profiles(reports):
+    totals = {}
+    for report in reports:
+        phases = totals.setdefault(report['sim_type'],{})
+        for phase,stats in report['phases'].items():
+            total = phases.setdefault(phase,{'calls':0,'time':0,'self_time':0})
+            for key in total:
+                total[key] += stats[key]
+    return totals
 
 
 #######################################
 ####### Monte Carlo simulations #######
 #######################################
 
+#A stream of uniform random numbers that can be shared by several monte carlo sims (common random numbers).
+#Number k used by turn t is the same in every sim that uses the stream, and cards are picked by inverse CDF,
+#so sims with nearby parameters simulate nearly the same turns.  Then differences between them have much less noise.
+#The numbers for each group of turn_group turns are generated block_width draws at a time, from a generator seeded by
+#(seed, group, block), so they don't depend on the order in which they're needed.  Generated numbers are kept for reuse,
+#which takes 8 bytes per turn per draw, but only for the max_groups groups used most recently.  Older groups are
+#dropped, and generated again (identically) if they're needed again.
+class uniform_stream:
+    turn_group = 1000
+    block_width = 64
+    max_groups = 32 #at least batch_size/turn_group, so that a batch of turns doesn't drop its own groups
+    
+    def __init__(self,seed=0):
+        self.seed = seed
+        self.groups = {} #array of numbers for each group of turns, with a row per turn, in order of last use
+    
+    #Returns the numbers for the given turns and draws (arrays of the same length)
+    def uniforms(self,turns,draws):
+        result = np.empty(len(turns))
+        groups = turns // self.turn_group
+        for group in np.unique(groups):
+            in_group = groups == group
+            self.extend(group,np.max(draws[in_group]) + 1)
+            result[in_group] = self.groups[group][turns[in_group] % self.turn_group,draws[in_group]]
+        return result
+    
+    #Generates numbers for group until there are at least width for each turn.  The width is doubled each time.
+    #The group becomes the most recently used.
+    def extend(self,group,width):
+        numbers = self.groups.pop(group,np.empty((self.turn_group,0)))
+        if numbers.shape[1] < width:
+            blocks = max(-(-width // self.block_width),2*(numbers.shape[1] // self.block_width))
+            new_blocks = [random.default_rng([self.seed,group,block]).random((self.turn_group,self.block_width))
+                          for block in range(numbers.shape[1] // self.block_width,blocks)]
+            numbers = np.concatenate([numbers] + new_blocks,axis=1)
+        self.groups[group] = numbers
+        while len(self.groups) > self.max_groups:
+            del self.groups[next(iter(self.groups))]
+
 #This is the abstract class of sims that use a monte carlo method
 class monte_sim(dom_sim):        
     #sim_type = "Monte <etc.>"
@@ -168,17 +425,24 @@ class monte_sim(dom_sim):
     
     #This draws a single card.  By default, this assumes an infinite deck.
     def draw(self):
-        rn = random.rand()
-        for i in range(self.card_types-1):
-            if rn < self.p_vector[i]:
-                i -= 1
-                break
-            else:
-                rn -= self.p_vector[i]
-        i += 1
-        self.card_vector[i] += 1
+        self.card_vector[self.sample_card()] += 1
         self.cards_drawn += 1
     
+    #Returns the type of a card drawn from an infinite deck, where p_vector is the fraction of each type (the last is implied).
+    #Cards are sampled card_buffer_size at a time, with a single search of the cumulative p_vector, and handed out one at a time.
+    #The buffer carries over from turn to turn, and is emptied when a simulation starts.
+    card_buffer_size = 4096
+    card_buffer = []
+    buffer_position = 0
+    
+    def sample_card(self):
+        if self.buffer_position == len(self.card_buffer):
+            p_cumulative = np.cumsum(self.p_vector[:self.card_types-1])
+            self.card_buffer = np.searchsorted(p_cumulative,self.rng.random(self.card_buffer_size),side='right').tolist()
+            self.buffer_position = 0
+        self.buffer_position += 1
+        return self.card_buffer[self.buffer_position-1]
+    
     #Plays a single action.  success is false if this fails
     #def action(self):
     #    return success
@@ -199,32 +463,287 @@ class monte_sim(dom_sim):
         else:
             return self.card_vector[0] #here we assume the first item of card_vector is copper
     
+    #The batched engine simulates many turns at once.  Each turn is a "lane", and the state of every lane is kept in numpy arrays:
+    #lane_card_vector[lane,card] is the hand, lane_action_supply and lane_cards_drawn are per lane,
+    #and lane_alive is a mask of lanes whose turn hasn't ended yet.
+    batched = True #If False, sim() falls back on simulating one turn at a time
+    batch_size = 10000 #maximum number of lanes simulated at once
+    stream_chunk = 1000 #number of turns in a chunk with its own random stream (with a seed or more than one worker)
+
+    #Initializes the state of num_lanes turns.  The batched counterpart of monte_init.
+    def batch_init(self,num_lanes):
+        self.lane_cards_drawn = np.zeros(num_lanes,dtype=int)
+        self.lane_action_supply = np.ones(num_lanes,dtype=int)
+        self.lane_card_vector = np.zeros((num_lanes,self.card_types),dtype=int)
+        self.lane_alive = np.ones(num_lanes,dtype=bool)
+        self.lane_uniforms_used = np.zeros(num_lanes,dtype=int)
+        self.batch_init_p_vector(num_lanes)
+
+    #By default, this assumes an infinite deck, so every lane shares the same p_vector.
+    #p_cumulative is used to pick the card type with a single search instead of walking the p_vector.
+    def batch_init_p_vector(self,num_lanes):
+        self.init_p_vector()
+        self.p_cumulative = np.cumsum(self.p_vector[:self.card_types-1])
+
+    #Returns a uniform random number for each of the given lanes.  With a common_stream, lane i of the chunk starting
+    #at first_turn uses the numbers of turn first_turn+i, in order.
+    def lane_uniforms(self,lanes):
+        if self.common_stream is None:
+            return self.rng.random(len(lanes))
+        draws = self.lane_uniforms_used[lanes]
+        self.lane_uniforms_used[lanes] += 1
+        return self.common_stream.uniforms(self.first_turn + lanes,draws)
+
+    #Returns count uniform random numbers for each of the given lanes, as a matrix with a row per lane
+    def lane_uniform_rows(self,lanes,count):
+        if self.common_stream is None:
+            return self.rng.random((len(lanes),count))
+        draws = self.lane_uniforms_used[lanes,np.newaxis] + np.arange(count)
+        self.lane_uniforms_used[lanes] += count
+        return np.reshape(self.common_stream.uniforms(np.repeat(self.first_turn + lanes,count),draws.ravel()),(len(lanes),count))
+    
+    #Draws a single card in each of the given lanes (an array of lane indices).  By default, this assumes an infinite deck.
+    def batch_draw(self,lanes):
+        rn = self.lane_uniforms(lanes)
+        cards = np.searchsorted(self.p_cumulative,rn,side='right')
+        self.lane_card_vector[lanes,cards] += 1
+        self.lane_cards_drawn[lanes] += 1
+
+    #Plays a single action in each of the given lanes.  Returns a boolean array, which is false where this fails
+    #def batch_action(self,lanes):
+    #    return success
+
+    #Simulates num_lanes turns at once.  Returns an array of payoffs, with np.inf for turns that reached the card cap.
+    def batch_turn(self,num_lanes):
+        self.batch_init(num_lanes)
+        lanes = np.arange(num_lanes)
+        for i in range(5):
+            self.batch_draw(lanes)
+
+        max_cards = self.parameters[0] #for finite simulations this condition is irrelevant
+        capped = self.lane_cards_drawn >= max_cards #lanes that stopped at the card cap rather than by failing an action
+        self.lane_alive &= ~capped
+        lanes = np.flatnonzero(self.lane_alive)
+        while len(lanes) > 0:
+            action_check = self.batch_action(lanes)
+            self.lane_alive[lanes[~action_check]] = False
+            lanes = lanes[action_check]
+            at_cap = self.lane_cards_drawn[lanes] >= max_cards
+            capped[lanes[at_cap]] = True
+            self.lane_alive[lanes[at_cap]] = False
+            lanes = lanes[~at_cap]
+
+        payoff = self.lane_card_vector[:,0].astype(float) #here we assume the first item of card_vector is copper
+        if not self.is_finite:
+            payoff[capped] = np.inf
+        return payoff
+
+    #Random numbers are drawn from rng.  By default this is the global numpy.random state, but a seeded
+    #numpy.random.Generator is used instead for each chunk when sim() is given a seed or more than one worker
+    #(or for the whole sim, when it isn't batched).
+    rng = random
+    seed = None #seed passed to sim()
+    workers = 1 #number of processes passed to sim()
+    common_stream = None #uniform_stream passed to sim()
+
+    #Sequential mode: instead of always running num_sims turns, turns are run check_size at a time until the
+    #standard errors of the mean and reliability are below mean_tolerance and reliability_tolerance.
+    #num_sims is then the maximum number of turns.  None means no target for that statistic.
+    mean_tolerance = None
+    reliability_tolerance = None
+    check_size = 1000
+    confidence = 1.96 #number of standard errors in the reported confidence intervals (1.96 is 95%)
+
+    #Runs the simulation.  With a seed, the turns are split into chunks of stream_chunk, and each chunk gets its own
+    #random stream spawned from numpy.random.SeedSequence(seed).  The chunks don't depend on the number of workers,
+    #so the same seed gives identical results whether the chunks are run in one process or in a pool of workers.
+    #Without the batched engine, the seed seeds a single numpy.random.Generator, and there is only one worker.
+    #The seed isn't stored in the database, so giving a seed always runs the simulation rather than looking it up.
+    #workers > 1 without a seed runs independent (but not reproducible) streams in parallel.
+    #Giving mean_tolerance or reliability_tolerance turns on sequential mode.  Afterwards, turns_used, mean_ci and
+    #reliability_ci describe what was achieved.  The stored row has the number of turns used in place of num_sims,
+    #so sequential mode can't be looked up in the database, and always runs the simulation.
+    #Giving a common_stream (a uniform_stream) takes the random numbers from it instead, and ignores seed and workers.
+    #Results from the database may not have used the same stream, so sweeps with common random numbers should use force=True.
+    #backend chooses how batches of turns are simulated (see kernel_turn): 'numpy' is the batched engine,
+    #'kernel' is the sim's turn kernel (compiled if numba is installed), and 'python' is the same kernel uncompiled.
+    #'numpy' is the default because without numba, 'kernel' is about 3-8x slower than it.  Check the speedups reported
+    #by python simBenchmark.py parity (with numba installed) before using 'kernel' for speed.
+    def sim(self,force=False,seed=None,workers=1,mean_tolerance=None,reliability_tolerance=None,common_stream=None,backend='numpy'):
+        if common_stream is not None and not self.batched:
+            raise ValueError("Error: common random numbers need the batched engine")
+        if workers > 1 and not self.batched:
+            raise ValueError("Error: more than one worker needs the batched engine")
+        if backend != 'numpy' and self.kernel is None:
+            raise ValueError("Error: this sim has no turn kernel")
+        if seed is not None or mean_tolerance is not None or reliability_tolerance is not None:
+            force = True
+        self.seed = seed
+        self.workers = workers
+        self.mean_tolerance = mean_tolerance
+        self.reliability_tolerance = reliability_tolerance
+        self.common_stream = common_stream
+        self.backend = backend
+        return dom_sim.sim(self,force)
+
+    #Simulates num_lanes turns, and returns the count, sum and sum of squares of the finite payoffs.
+    #Payoffs are whole numbers of coppers, so the totals are python ints, and merging chunks is exact in any order.
+    def batch_totals(self,num_lanes):
+        payoff = self.batch_turn(num_lanes) if self.backend == 'numpy' else self.kernel_turn(num_lanes)
+        payoff = payoff[np.isfinite(payoff)].astype(np.int64)
+        return (len(payoff),int(np.sum(payoff)),int(np.sum(payoff**2)))
+
+    #Yields the totals of each chunk (a list of numbers of turns), in order.
+    #In parallel, chunks are run workers at a time, so stopping early wastes at most one round.
+    def chunk_totals(self,chunks):
+        if self.common_stream is not None:
+            self.first_turn = 0
+            for num_lanes in chunks:
+                yield self.batch_totals(num_lanes)
+                self.first_turn += num_lanes
+            return
+        if self.seed is None and self.workers <= 1:
+            for num_lanes in chunks:
+                yield self.batch_totals(num_lanes)
+            return
+        streams = random.SeedSequence(self.seed).spawn(len(chunks))
+        if self.workers <= 1:
+            for num_lanes,stream in zip(chunks,streams):
+                yield run_chunk(self,num_lanes,stream)
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for start in range(0,len(chunks),self.workers):
+                end = start + self.workers
+                yield from pool.map(run_chunk,[self]*len(chunks[start:end]),chunks[start:end],streams[start:end])
+
+    #Calculates (mean, stdev, reliability) and their standard errors from the running totals
+    def monte_stats(self,count,total,sqtotal,num_sims):
+        reliability = 1 - count/num_sims
+        #The reliability error uses the Agresti-Coull adjustment, so it isn't zero when no turns (or every turn) reached the cap
+        adjusted = (num_sims - count + 2)/(num_sims + 4)
+        reliability_error = (adjusted*(1-adjusted)/(num_sims + 4)) ** 0.5
+        if count == 0:
+            return (np.nan,np.nan,reliability,np.inf,reliability_error)
+        mean = total / count
+        stdev = sqtotal / count - mean**2
+        if stdev < 0:
+            stdev = 0 #necessary because sometimes rounding errors make it negative
+        else:
+            stdev = stdev ** 0.5
+        mean_error = stdev / (count-1) ** 0.5 if count > 1 else np.inf
+        return (mean,stdev,reliability,mean_error,reliability_error)
+
+    #Whether the standard errors are within the tolerances of sequential mode
+    def precise_enough(self,mean_error,reliability_error):
+        if self.mean_tolerance is None and self.reliability_tolerance is None:
+            return False
+        if self.mean_tolerance is not None and not mean_error <= self.mean_tolerance:
+            return False
+        if self.reliability_tolerance is not None and not reliability_error <= self.reliability_tolerance:
+            return False
+        return True
+
+    #Turn kernels (see dominionKernels) simulate one turn at a time in plain loops, which numba can compile.
+    #Subclasses that have one set kernel, and kernel_arguments() returns its arguments after the uniforms.
+    #The kernel gets kernel_width random numbers per turn, and turns that need more are run again with twice as many.
+    #The numbers come from the common_stream, in the same order as the batched engine, or else from rng, a matrix at a time.
+    #So for a given seed, the compiled and python kernels give bit-identical results, and with a common_stream,
+    #they are also identical to the batched engine.
+    kernel = None
+    kernel_width = 64
+    backend = 'numpy' #backend passed to sim()
+    
+    #def kernel_arguments(self):
+    #    return (<etc.>)
+    
+    #Returns count random numbers for each of the given lanes, starting at number start of each turn
+    def kernel_uniforms(self,lanes,start,count):
+        if self.common_stream is None:
+            return self.rng.random((len(lanes),count))
+        turns = np.repeat(self.first_turn + lanes,count)
+        draws = np.tile(np.arange(start,start+count),len(lanes))
+        return np.reshape(self.common_stream.uniforms(turns,draws),(len(lanes),count))
+    
+    #Simulates num_lanes turns with the turn kernel.  Returns an array of payoffs, like batch_turn.
+    def kernel_turn(self,num_lanes):
+        kernel = python_kernel(self.kernel) if self.backend == 'python' else self.kernel
+        arguments = self.kernel_arguments()
+        payoff = np.empty(num_lanes)
+        lanes = np.arange(num_lanes)
+        width = self.kernel_width
+        uniforms = self.kernel_uniforms(lanes,0,width)
+        while len(lanes) > 0:
+            (lane_payoff,used) = kernel(uniforms,*arguments)
+            done = used <= width
+            payoff[lanes[done]] = lane_payoff[done]
+            lanes = lanes[~done]
+            uniforms = np.concatenate([uniforms[~done],self.kernel_uniforms(lanes,width,width)],axis=1)
+            width *= 2
+        return payoff
+    
     #Runs the simulation multiple times and collects statistics
-    def sim(self):
+    def simulate(self):
         running_count = 0
         running_sum = 0
         running_sqsum = 0
+        turns_used = 0
         num_sims = self.parameters[1]
-        for i in range(num_sims):
-            payoff = self.turn()
-            if np.isfinite(payoff):
-                running_count += 1
-                running_sum += payoff
-                running_sqsum += payoff**2
-
-        reliability = 1 - running_count/num_sims
+        sequential = self.mean_tolerance is not None or self.reliability_tolerance is not None
+        check_size = self.check_size if sequential else num_sims
+        if self.batched:
+            #the chunks with their own random streams are always the same size, so they don't depend on check_size or batch_size
+            streams = self.common_stream is None and (self.seed is not None or self.workers > 1)
+            chunk_size = self.stream_chunk if streams else min(self.batch_size,check_size)
+            chunks = [min(chunk_size,num_sims-start) for start in range(0,num_sims,chunk_size)]
+            next_check = check_size
+            for num_lanes,(count,total,sqtotal) in zip(chunks,self.chunk_totals(chunks)):
+                turns_used += num_lanes
+                running_count += count
+                running_sum += total
+                running_sqsum += sqtotal
+                if sequential and turns_used >= next_check:
+                    next_check = (turns_used//check_size + 1)*check_size
+                    if self.precise_enough(*self.monte_stats(running_count,running_sum,running_sqsum,turns_used)[3:]):
+                        break
+        else:
+            if self.seed is not None:
+                self.rng = random.default_rng(self.seed)
+            self.card_buffer = []
+            self.buffer_position = 0
+            for i in range(num_sims):
+                payoff = self.turn()
+                turns_used += 1
+                if np.isfinite(payoff):
+                    running_count += 1
+                    running_sum += payoff
+                    running_sqsum += payoff**2
+                if sequential and turns_used % check_size == 0:
+                    if self.precise_enough(*self.monte_stats(running_count,running_sum,running_sqsum,turns_used)[3:]):
+                        break
+            if self.seed is not None:
+                del self.rng #go back to the default rng
+
+        (mean,stdev,reliability,mean_error,reliability_error) = self.monte_stats(running_count,running_sum,running_sqsum,turns_used)
+        self.turns_used = turns_used
+        self.mean_ci = (mean - self.confidence*mean_error,mean + self.confidence*mean_error)
+        self.reliability_ci = (max(reliability - self.confidence*reliability_error,0),min(reliability + self.confidence*reliability_error,1))
+
+        #The row records the number of turns actually used
+        self.parameters[1] = turns_used
         if running_count > 0:
-            mean = running_sum / running_count
-            stdev = running_sqsum / running_count - mean**2
-            if stdev < 0:
-                stdev = 0 #necessary because sometimes rounding errors make it negative
-            else:
-                stdev = stdev ** 0.5
             self.write_to_sql(mean,stdev,reliability)
-            return(mean,stdev,reliability)
         else:
             self.write_to_sql(0,0,reliability)
-            return(np.nan,np.nan,reliability)
+        self.parameters[1] = num_sims
+        return(mean,stdev,reliability)
+
+#Simulates one chunk of a monte carlo sim using its own random stream.  This is run in the worker processes.
+def run_chunk(sim,num_lanes,stream):
+    sim.rng = random.default_rng(stream)
+    try:
+        return sim.batch_totals(num_lanes)
+    finally:
+        del sim.rng #go back to the default rng
 
 #A monte carlo sim for an infinite lab_copper deck.
 class monte_lab_inf(monte_sim):
@@ -246,6 +765,10 @@ class monte_lab_inf(monte_sim):
     def init_p_vector(self):
         self.p_vector = [1-self.parameters[2]]
     
+    kernel = staticmethod(lab_inf_turns)
+    def kernel_arguments(self):
+        return (self.parameters[0],np.array([1-self.parameters[2]]))
+    
     #Plays a lab if able
     def action(self):
         if self.card_vector[1] >= 1:
@@ -256,6 +779,15 @@ class monte_lab_inf(monte_sim):
         else:
             return False
 
+    #Plays a lab in each lane that is able
+    def batch_action(self,lanes):
+        success = self.lane_card_vector[lanes,1] >= 1
+        lanes = lanes[success]
+        self.lane_card_vector[lanes,1] -= 1
+        self.batch_draw(lanes)
+        self.batch_draw(lanes)
+        return success
+
 #A monte carlo sim for a finite lab/copper deck
 class monte_lab_fin(monte_lab_inf):
     
@@ -271,26 +803,124 @@ class monte_lab_fin(monte_lab_inf):
         self.parameters = [deck_size,num_sims,num_labs]
         self.monte_init()
     
-    #Here, the p_vector is the number of cards of each type remaining in the deck.
+    #Here, the p_vector is the number of cards of each type in the deck.
     def init_p_vector(self):
         self.p_vector = [self.parameters[0]-self.parameters[2],self.parameters[2]]
     
-    #This function must be overridden, because p_vector is a different format
+    kernel = staticmethod(lab_fin_turns)
+    def kernel_arguments(self):
+        return (np.array([self.parameters[0]-self.parameters[2],self.parameters[2]]),)
+    
+    #Instead of picking each card from what's left of the deck, the whole deck is shuffled at the start of the turn,
+    #and draws take the next card of deck_order.  cards_drawn is not used.
+    def monte_init(self):
+        monte_sim.monte_init(self)
+        self.deck_order = shuffled_deck(self.p_vector,self.rng.random(sum(self.p_vector))).tolist()
+        self.deck_position = 0
+    
+    def draw(self):
+        if self.deck_position == len(self.deck_order):
+            #draw fails because deck is empty
+            return
+        self.card_vector[self.deck_order[self.deck_position]] += 1
+        self.deck_position += 1
+
+    #Here each lane has its own shuffled deck, a row of lane_deck_order, and lane_deck_position is its next card.
+    #The deck is shuffled with the first deck_size random numbers of the turn.
+    def batch_init_p_vector(self,num_lanes):
+        self.init_p_vector()
+        uniforms = self.lane_uniform_rows(np.arange(num_lanes),sum(self.p_vector))
+        self.lane_deck_order = shuffled_deck(self.p_vector,uniforms)
+        self.lane_deck_position = np.zeros(num_lanes,dtype=int)
+
+    #Like draw(), lanes with an empty deck draw nothing.
+    def batch_draw(self,lanes):
+        lanes = lanes[self.lane_deck_position[lanes] < self.lane_deck_order.shape[1]]
+        cards = self.lane_deck_order[lanes,self.lane_deck_position[lanes]]
+        self.lane_card_vector[lanes,cards] += 1
+        self.lane_deck_position[lanes] += 1
+
+#Returns a shuffled deck with counts[i] cards of type i, as an array of card types.  The order is the sort order of uniforms,
+#which is either one number per card, or a matrix with a row of numbers for each of several decks.
+def shuffled_deck(counts,uniforms):
+    return np.repeat(np.arange(len(counts)),counts)[np.argsort(uniforms,axis=-1)]
+
+#A monte carlo sim of num_turns turns of a finite lab/copper deck, with reshuffles.  See markov_lab_turns.
+#The payoff is the total over all the turns.  pile is the draw pile at the start of the turn, and discard is the discard pile.
+class monte_lab_turns(monte_lab_fin):
+    
+    sim_type = "Monte Lab Finite Turns"
+    parameter_names = ["deck_size","stat_weight","num_labs","num_turns"]
+    is_finite = True
+    version = 1
+    
+    def __init__(self,num_labs,deck_size=30,num_sims=1000,num_turns=10):
+        if not isinstance(num_labs,int):
+            raise ValueError("Error: expected integer number of labs")
+            return
+        self.parameters = [deck_size,num_sims,num_labs,num_turns]
+        self.pile = [deck_size-num_labs,num_labs]
+        self.monte_init()
+    
+    #The turn kernel of monte_lab_fin only simulates one turn
+    kernel = None
+    
+    #Here the p_vector is the number of cards of each type remaining in the draw pile, and cards are picked from what's left,
+    #rather than from a shuffled deck, so that the draw pile and discard pile can carry over between turns.
+    monte_init = monte_sim.monte_init
+    
+    def init_p_vector(self):
+        self.p_vector = list(self.pile)
+        self.discard = [self.parameters[0]-self.parameters[2]-self.pile[0],self.parameters[2]-self.pile[1]]
+    
+    #When the draw pile runs out, the discard pile is shuffled into a new one
     def draw(self):
+        if sum(self.p_vector) == 0:
+            (self.p_vector,self.discard) = (self.discard,[0,0])
         cards_left = sum(self.p_vector)
         if cards_left == 0:
             #draw fails because deck is empty
             return
-        rn = random.rand()*cards_left
-        for i in range(self.card_types-1):
-            if rn < self.p_vector[i]:
-                i -= 1
-                break
-            else:
-                rn -= self.p_vector[i]
-        i += 1
-        self.card_vector[i] += 1
-        self.p_vector[i] -= 1
+        card = int(self.rng.random()*cards_left >= self.p_vector[0])
+        self.card_vector[card] += 1
+        self.p_vector[card] -= 1
+    
+    def turn(self):
+        self.pile = [self.parameters[0]-self.parameters[2],self.parameters[2]]
+        total = 0
+        for i in range(self.parameters[3]):
+            total += monte_lab_fin.turn(self)
+            self.pile = self.p_vector
+        return total
+    
+    def batch_init_p_vector(self,num_lanes):
+        self.lane_p_vector = self.lane_pile.copy()
+        self.lane_discard = np.array([self.parameters[0]-self.parameters[2],self.parameters[2]]) - self.lane_pile
+    
+    #Each turn starts from a new batch_init, but with common random numbers, the lanes carry on through their stream
+    def batch_init(self,num_lanes):
+        used = self.lane_uniforms_used if self.turn_number > 0 else 0
+        monte_lab_fin.batch_init(self,num_lanes)
+        self.lane_uniforms_used += used
+    
+    def batch_draw(self,lanes):
+        reshuffle = lanes[np.sum(self.lane_p_vector[lanes],axis=1) == 0]
+        self.lane_p_vector[reshuffle] = self.lane_discard[reshuffle]
+        self.lane_discard[reshuffle] = 0
+        cards_left = np.sum(self.lane_p_vector[lanes],axis=1)
+        lanes = lanes[cards_left > 0]
+        rn = self.lane_uniforms(lanes)*cards_left[cards_left > 0]
+        cards = (rn >= self.lane_p_vector[lanes,0]).astype(int)
+        self.lane_card_vector[lanes,cards] += 1
+        self.lane_p_vector[lanes,cards] -= 1
+    
+    def batch_turn(self,num_lanes):
+        self.lane_pile = np.tile([self.parameters[0]-self.parameters[2],self.parameters[2]],(num_lanes,1))
+        total = np.zeros(num_lanes)
+        for self.turn_number in range(self.parameters[3]):
+            total += monte_lab_fin.batch_turn(self,num_lanes)
+            self.lane_pile = self.lane_p_vector
+        return total
     
 #A monte carlo sim for an infinite village/smithy deck.
 class monte_vsm_inf(monte_sim):
@@ -311,6 +941,10 @@ class monte_vsm_inf(monte_sim):
     #p_vector is the fraction of [coppers,villages] in deck
     def init_p_vector(self):
         self.p_vector = [1-self.parameters[2]-self.parameters[3],self.parameters[2]]
+    
+    kernel = staticmethod(vsm_inf_turns)
+    def kernel_arguments(self):
+        return (self.parameters[0],np.cumsum([1-self.parameters[2]-self.parameters[3],self.parameters[2]]))
         
     #Plays a village if able, otherwise a smithy
     def action(self):
@@ -334,6 +968,27 @@ class monte_vsm_inf(monte_sim):
         else:
             #if no cards to play, this fails
             return False
+
+    #Plays a village in each lane that is able, otherwise a smithy
+    def batch_action(self,lanes):
+        supply = self.lane_action_supply[lanes]
+        village = (supply > 0) & (self.lane_card_vector[lanes,1] >= 1)
+        smithy = (supply > 0) & ~village & (self.lane_card_vector[lanes,2] >= 1)
+
+        #play a village
+        played = lanes[village]
+        self.lane_card_vector[played,1] -= 1
+        self.batch_draw(played)
+        self.lane_action_supply[played] += 1
+
+        #play a smithy
+        played = lanes[smithy]
+        self.lane_card_vector[played,2] -= 1
+        self.batch_draw(played)
+        self.batch_draw(played)
+        self.batch_draw(played)
+        self.lane_action_supply[played] -= 1
+        return village | smithy
     
 #Just for fun, here's a sim of a Herald deck
 class monte_herald_inf(monte_sim):
@@ -355,18 +1010,14 @@ class monte_herald_inf(monte_sim):
     def init_p_vector(self):
         self.p_vector = [1-self.parameters[2],0]
         self.p_vector[self.card_types-1] = self.check_top()
+    
+    kernel = staticmethod(herald_inf_turns)
+    def kernel_arguments(self):
+        return (self.parameters[0],np.array([1-self.parameters[2]]))
         
     #Randomizes the identity of the card on top
     def check_top(self):
-        rn = random.rand()
-        for i in range(self.card_types-1):
-            if rn < self.p_vector[i]:
-                i -= 1
-                break
-            else:
-                rn -= self.p_vector[i]
-        i += 1
-        return i
+        return self.sample_card()
     
     #Draws the top card, and checks top
     def draw(self):
@@ -385,6 +1036,31 @@ class monte_herald_inf(monte_sim):
             return True
         else:
             return False
+
+    #Each lane has its own top card, stored in lane_top
+    def batch_init_p_vector(self,num_lanes):
+        monte_sim.batch_init_p_vector(self,num_lanes)
+        self.lane_top = self.batch_check_top(np.arange(num_lanes))
+
+    #Randomizes the identity of the card on top, for each of the given lanes
+    def batch_check_top(self,lanes):
+        return np.searchsorted(self.p_cumulative,self.lane_uniforms(lanes),side='right')
+
+    #Draws the top card, and checks top, in each of the given lanes
+    def batch_draw(self,lanes):
+        self.lane_card_vector[lanes,self.lane_top[lanes]] += 1
+        self.lane_top[lanes] = self.batch_check_top(lanes)
+        self.lane_cards_drawn[lanes] += 1
+
+    #Plays a herald in each lane that is able
+    def batch_action(self,lanes):
+        success = self.lane_card_vector[lanes,1] >= 1
+        lanes = lanes[success]
+        self.lane_card_vector[lanes,1] -= 1
+        self.batch_draw(lanes)
+        #If top card is a herald, draw again
+        self.batch_draw(lanes[self.lane_top[lanes] == 1])
+        return success
         
 #######################################
 ####### Markov Chain simulations ######
@@ -403,12 +1079,39 @@ class markov_sim(dom_sim):
         #check if parameters are right types
     #    self.parameters = <etc.>
     
+    #Markov sims that support it can run many parameter points at once, by giving 1-d arrays of parameters.
+    #All points must share max_cards (and anything else that sets the size of the state_vector).
+    #Then the state_vector and everything derived from it has a leading batch dimension with one entry per point,
+    #and sim() returns arrays of (mean,stdev,reliability).  Each point is still written to the database as a separate row.
+    batch_elements = 2**20 #maximum size of a batched state_vector.  Larger batches are split up to stay in cache.
+    
+    #Shape of the batch dimension: () for a single point, or (number of points,)
+    def get_batch_shape(self):
+        batch_shape = np.broadcast(*self.parameters).shape
+        if len(batch_shape) > 1:
+            raise ValueError("Error: expected 1-d arrays of parameters")
+        return batch_shape
+    
+    #Reshapes a (possibly batched) coefficient so that it broadcasts against arrays with extra_dims non-batch dimensions.
+    #A scalar coefficient is repeated for every point, since other parameters may be batched when it isn't.
+    def batch_coefficient(self,coefficient,extra_dims=1):
+        return np.reshape(np.broadcast_to(coefficient,self.batch_shape),self.batch_shape + (1,)*extra_dims)
+    
+    #Returns a copy of the sim restricted to some of its points.  With an integer index, this is a single-point sim.
+    def batch_subset(self,index):
+        subset = copy.copy(self)
+        batch_shape = self.get_batch_shape()
+        subset.parameters = [np.broadcast_to(p,batch_shape)[index] if np.ndim(p) > 0 else p for p in self.parameters]
+        subset.parameters = [p.item() if np.ndim(p) == 0 and isinstance(p,np.generic) else p for p in subset.parameters]
+        return subset
+    
     #Initializes parameters for the start of turn.
     def markov_init(self):
+        self.batch_shape = self.get_batch_shape()
         self.num_cards = 0 #number of cards in hand and play.  Used to limit simulation length.
         self.hand_size = 0 #number of cards in hand.  Used to infer e.g. the number of coppers in hand.
-        self.state_vector = np.matrix(np.zeros((self.parameters[0],1))) #the probability of the game being in any particular state
-        self.state_vector[0] = 1
+        self.state_vector = np.zeros(self.batch_shape + (self.parameters[0],)) #the probability of the game being in any particular state
+        self.state_vector[...,0] = 1
         #In general, state_vector will be a multi-rank tensor
         #e.g. rows=[number of first action card], columns=[number of 2nd action card], layers=[action supply]
         #but I can't always follow this scheme, since it's so important to reduce the dimensionality.
@@ -422,56 +1125,310 @@ class markov_sim(dom_sim):
     def calc_draw_matrix(self):
         return True
     
+    #By default the draw matrix is bidiagonal: a draw either leaves the state alone or moves it up by one.
+    #So only the two diagonals are stored (draw_diag and draw_subdiag), and the draw is a vector shift instead of a matrix product.
+    #The state counts cards in hand, so states above hand_size are empty and can be skipped.
     def draw(self):
         if self.calc_draw_matrix():
-            self.state_vector = self.draw_matrix * self.state_vector
+            window = min(self.hand_size + 2,self.state_vector.shape[-1])
+            state = self.state_vector[...,:window]
+            moved = self.draw_subdiag[...,:window-1] * state[...,:-1]
+            state *= self.draw_diag[...,:window]
+            state[...,1:] += moved
             self.num_cards += 1
             self.hand_size += 1
     
-    #Plays a single action.  Returns the contribution to the payoff vector in case of failure
+    #Plays a single action, and adds the probability of failure to payoff_vector, at the payoff in case of failure
     #def action(self):
-    #    return failure_payoff
+    
+    #If tolerance is positive, turn() stops as soon as the probability that the turn is still going falls below tolerance.
+    #Whatever probability remains is counted towards reliability, as if it had reached the card cap.
+    tolerance = 0
+    
+    #Returns the probability that the turn is still going, not counting probability that has already reached the card cap.
+    #By default this is everything in the state_vector.
+    def live_mass(self):
+        return np.sum(np.reshape(self.state_vector,self.batch_shape + (-1,)),axis=-1)
+    
+    #Tail absorption: in infinite decks, a turn with a large surplus of draw is almost certain to go on forever.
+    #If absorb_tolerance is positive, then after every action, any state whose probability of ever failing is below
+    #absorb_tolerance is removed from the state_vector and counted towards reliability, as if it had reached the card cap.
+    #Subclasses that support this provide ruin_bound(), an upper bound on the probability of ever failing from each state,
+    #for a deck with no card cap.  Then the live probability dies out quickly, and with a positive tolerance, turn() stops early.
+    #absorbed_mass is the total probability absorbed.  absorption_error is the sum of the absorbed probability times its
+    #ruin_bound, which bounds how much absorption overstates reliability (compared to the same chain with no card cap).
+    #The mean is calculated without the absorbed probability.
+    absorb_tolerance = 0
+    
+    #Returns an array the shape of the state_vector, with an upper bound on the probability of ever failing from each state
+    #def ruin_bound(self):
+    
+    #Settings that make the results approximate, and the value of each that is exact.  Stopping early (tolerance)
+    #and tail absorption both change the results, so any setting that isn't exact is added to the name results are
+    #stored under, e.g. "Markov Lab Infinite (tolerance 1e-12)".  Approximate results are then looked up and stored like
+    #any other results, but are kept apart from exact results, and from results with other settings.
+    exact_settings = {'tolerance':0,'absorb_tolerance':0}
+    
+    def result_type(self):
+        settings = ['%s %g' % (name,getattr(self,name)) for name,exact in self.exact_settings.items() if getattr(self,name) != exact]
+        if len(settings) == 0:
+            return self.sim_type
+        return self.sim_type + ' (' + ', '.join(settings) + ')'
+    
+    #Returns the range of columns (last axis of the state_vector) that may hold live probability
+    def live_window(self):
+        return (0,min(self.hand_size + 1,self.state_vector.shape[-1]))
+    
+    def init_absorption(self):
+        self.absorbed_mass = np.zeros(self.batch_shape)
+        self.absorption_error = np.zeros(self.batch_shape)
+        if self.absorb_tolerance > 0:
+            self.ruin = self.ruin_bound()
+            #the first column where anything can be absorbed
+            absorbed_columns = np.flatnonzero(np.any(np.reshape(self.ruin < self.absorb_tolerance,(-1,self.ruin.shape[-1])),axis=0))
+            self.absorb_from = absorbed_columns[0] if len(absorbed_columns) > 0 else self.ruin.shape[-1]
+    
+    def absorb(self):
+        (lo,hi) = self.live_window()
+        lo = max(lo,self.absorb_from)
+        if hi > lo:
+            state = self.state_vector[...,lo:hi]
+            ruin = self.ruin[...,lo:hi]
+            absorbed = np.where(ruin < self.absorb_tolerance,state,0)
+            self.absorbed_mass += np.sum(np.reshape(absorbed,self.batch_shape + (-1,)),axis=-1)
+            self.absorption_error += np.sum(np.reshape(absorbed*ruin,self.batch_shape + (-1,)),axis=-1)
+            state -= absorbed
     
     #Draws 5 cards, and then plays actions until it reaches the maximum hand size
+    #num_steps records the number of actions that were simulated
     def turn(self):
         self.markov_init()
-        payoff_vector = np.zeros((self.parameters[0]+1)) #the probability of getting any particular finite payoff
+        self.payoff_vector = np.zeros(self.batch_shape + (self.parameters[0]+1,)) #the probability of getting any particular finite payoff
         for i in range(5):
             self.draw()
 
+        self.init_absorption()
+        if self.absorb_tolerance > 0:
+            self.absorb()
+
         max_cards = self.parameters[0]
+        self.num_steps = 0
+        self.snapshots = {}
+        self.take_snapshots()
+        self.history = []
+        if self.extrapolate:
+            self.record_history()
         while(self.num_cards < max_cards):
-            failure_payoff = self.action()
-            payoff_vector += failure_payoff
+            self.action()
+            self.num_steps += 1
+            if self.absorb_tolerance > 0:
+                self.absorb()
+            self.take_snapshots()
+            if self.extrapolate:
+                self.record_history()
+            if self.tolerance > 0 and np.all(self.live_mass() < self.tolerance):
+                break
         
+        #if the turn stopped early, the remaining checkpoints get the final payoff_vector
+        for cap in self.checkpoints:
+            if cap not in self.snapshots:
+                self.snapshots[cap] = self.payoff_vector[...,:cap+1].copy()
         if self.is_finite:
-            p_draw_all = 1 - np.sum(payoff_vector)
-            payoff_vector[self.p_vector[0]] += p_draw_all #It's assumed that p_vector[0] is the number of copper in deck.
+            p_draw_all = 1 - np.sum(self.payoff_vector)
+            self.payoff_vector[self.p_vector[0]] += p_draw_all #It's assumed that p_vector[0] is the number of copper in deck.
             
-        return payoff_vector
+        return self.payoff_vector
+    
+    #Card caps at which turn() saves a copy of the payoff_vector in snapshots.
+    #A snapshot is taken as soon as num_cards reaches the cap, which is exactly where a turn with that max_cards stops.
+    checkpoints = ()
+    
+    def take_snapshots(self):
+        for cap in self.checkpoints:
+            if cap not in self.snapshots and self.num_cards >= cap:
+                self.snapshots[cap] = self.payoff_vector[...,:cap+1].copy()
+    
+    #Returns a copy of the sim with a different max_cards
+    def with_cap(self,cap):
+        capped = copy.copy(self)
+        capped.parameters = [cap] + list(self.parameters[1:])
+        return capped
+    
+    #Runs the sim for several values of max_cards (caps) at once, by running to the largest cap and taking snapshots.
+    #Each cap is written to the database as a separate row.  Returns a dict of (mean,stdev,reliability) for each cap.
+    #Caps that are already in the database aren't simulated again, unless force=True.
+    #Batches of points are not looked up in the database.  Only meaningful for infinite sims.
+    def sim_caps(self,caps,force=False):
+        if self.is_finite:
+            raise ValueError("Error: caps only apply to sims of infinite decks")
+        results = {}
+        missing = []
+        for cap in sorted(set(caps)):
+            cached = None
+            if not (force or self.testing or self.get_batch_shape() != ()):
+                cached = self.sink.lookup(self.with_cap(cap))
+                self.cache_stats['misses' if cached is None else 'hits'] += 1
+            if cached is None:
+                missing.append(cap)
+            else:
+                results[cap] = cached
+        
+        if len(missing) > 0:
+            longest = self.with_cap(missing[-1])
+            longest.checkpoints = missing
+            longest.turn()
+            for cap in missing:
+                results[cap] = self.payoff_stats(longest.snapshots[cap])
+                self.with_cap(cap).write_results(*results[cap],longest.snapshots[cap])
+        return {cap:results[cap] for cap in sorted(results)}
+    
+    #Extrapolation to an infinite card cap.  If extrapolate is True, turn() records the probability of a finite payoff,
+    #and its first and second moments, after every action.  Near the end of the turn, the amount added each step decays
+    #roughly geometrically, so the rest can be estimated from the last extrapolate_window steps.  These are split into three
+    #blocks, and the ratio between the last two blocks gives the sum of the remaining geometric series.
+    #The error estimate (see below) is a heuristic, not a bound.  It is most reliable for reliability, and least for stdev.
+    #Near the phase transition the decay is slower than geometric, and the error estimate is correspondingly large (or inf).
+    #The decay can also slow down after the window (e.g. once states reach the cap on the action supply), which the window
+    #can't show.  So each error estimate is at least extrapolate_margin times the change that extrapolation made to that statistic.
+    extrapolate = False
+    extrapolate_window = 30
+    extrapolate_margin = 3
+    
+    def record_history(self):
+        payoff_vector = self.payoff_vector[...,:self.num_cards+1]
+        payoff = np.arange(payoff_vector.shape[-1])
+        self.history.append(np.stack([np.sum(payoff_vector,axis=-1),np.sum(payoff_vector*payoff,axis=-1),np.sum(payoff_vector*payoff**2,axis=-1)]))
+        del self.history[:-(self.extrapolate_window+1)]
+    
+    #Returns the extrapolated (mean,stdev,reliability), and sets extrapolation_error to the error estimates of each
+    def extrapolate_stats(self):
+        block = self.extrapolate_window // 3
+        history = np.array(self.history)
+        totals = history[-1]
+        if block == 0 or len(history) < 3*block + 1:
+            errors = np.full(totals.shape,np.inf)
+        else:
+            increments = np.diff(history[-(3*block+1):],axis=0)
+            (first,second,third) = [np.sum(increments[k*block:(k+1)*block],axis=0) for k in range(3)]
+            with np.errstate(invalid='ignore',divide='ignore'):
+                ratio = third/second
+                old_ratio = second/first
+                tail = third*ratio/(1-ratio)
+                #The ratio usually creeps up towards its limit like 1/steps (as in first passage times of a random walk),
+                #so the limit is about ratio + drift*(number of blocks so far).  The tail using that ratio is the error estimate.
+                limit_ratio = ratio + (ratio - old_ratio)*(self.num_steps/block)
+                limit_tail = third*limit_ratio/(1-limit_ratio)
+            decaying = (ratio >= 0) & (ratio < 1) & (limit_ratio >= 0) & (limit_ratio < 1)
+            finished = third == 0
+            errors = np.where(finished,0,np.where(decaying,np.abs(limit_tail-tail),np.inf))
+            tail = np.where(decaying & ~finished,tail,0)
+            #The probability of a finite payoff can't grow by more than what's still live
+            tail[0] = np.minimum(tail[0],self.live_mass())
+            totals = totals + tail
+        
+        (finite,first_moment,second_moment) = totals
+        (finite_error,first_error,second_error) = errors
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = first_moment/finite
+            sqmean = second_moment/finite
+            stdev = np.maximum(sqmean - mean**2,0) ** 0.5
+            mean_error = (first_error + np.abs(mean)*finite_error)/finite
+            stdev_error = ((second_error + sqmean*finite_error)/finite + 2*np.abs(mean)*mean_error)/(2*stdev)
+            (chain_finite,chain_first,chain_second) = history[-1]
+            chain_mean = chain_first/chain_finite
+            chain_stdev = np.maximum(chain_second/chain_finite - chain_mean**2,0) ** 0.5
+            mean_error = np.maximum(mean_error,self.extrapolate_margin*np.abs(mean - chain_mean))
+            stdev_error = np.maximum(stdev_error,self.extrapolate_margin*np.abs(stdev - chain_stdev))
+            finite_error = np.maximum(finite_error,self.extrapolate_margin*np.abs(finite - chain_finite))
+        reliability = 1 - finite
+        if np.ndim(reliability) == 0:
+            self.extrapolation_error = (mean_error[()],stdev_error[()],finite_error[()])
+            return (mean[()],stdev[()],reliability[()])
+        self.extrapolation_error = (mean_error,stdev_error,finite_error)
+        return (mean,stdev,reliability)
     
     #Simulates a turn, and then calculates statistics from the probabilities
-    def sim(self):
+    #The row written to the database always has the statistics of the chain itself, even if the extrapolation is returned.
+    def simulate(self):
         payoff_vector = self.turn()
+        (mean,stdev,reliability) = self.payoff_stats(payoff_vector)
+        self.write_results(mean,stdev,reliability,payoff_vector)
+        if self.extrapolate:
+            return self.extrapolate_stats()
+        return (mean,stdev,reliability)
+    
+    #Calculates (mean,stdev,reliability) from a payoff_vector (or a batch of them)
+    #mean and stdev are nan if there is no probability of a finite payoff
+    def payoff_stats(self,payoff_vector):
+        reliability = 1 - np.sum(payoff_vector,axis=-1)
+        payoff = np.arange(payoff_vector.shape[-1])
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = np.sum(payoff_vector*payoff,axis=-1) / (1-reliability)
+            sqmean = np.sum(payoff_vector*payoff**2,axis=-1) / (1-reliability)
+        stdev = np.maximum(sqmean - mean**2,0) ** 0.5 #max is necessary because sometimes rounding errors make it negative
+        finite = reliability < 1
+        mean = np.where(finite,mean,np.nan)
+        stdev = np.where(finite,stdev,np.nan)
+        if np.ndim(reliability) == 0:
+            return (mean[()],stdev[()],reliability[()])
+        return (mean,stdev,reliability)
+    
+    #If store_distributions is True, the payoff_vector is stored with the results (see init_sql_distributions)
+    store_distributions = True
+    
+    #Writes results to the database, one row per point
+    def write_results(self,mean,stdev,reliability,payoff_vector=None):
+        if np.ndim(reliability) > 0:
+            for k in range(len(reliability)):
+                self.batch_subset(k).write_results(mean[k],stdev[k],reliability[k],None if payoff_vector is None else payoff_vector[k])
+            return
+        if not self.store_distributions:
+            payoff_vector = None
+        if reliability < 1:
+            self.write_to_sql(mean,stdev,reliability,payoff_vector)
+        else:
+            self.write_to_sql(0,0,reliability,payoff_vector)
+    
+    #With a batch of points, each point is looked up in the database separately, and only the missing points are simulated.
+    #Large batches are split so that the state_vector has at most batch_elements entries.
+    #extrapolate=True returns the statistics extrapolated to an infinite card cap (see extrapolate_stats), which always
+    #requires running the sim.
+    def sim(self,force=False,extrapolate=False):
+        if extrapolate and self.is_finite:
+            raise ValueError("Error: extrapolation only applies to sims of infinite decks")
+        self.extrapolate = extrapolate
+        force = force or extrapolate
+        batch_shape = self.get_batch_shape()
+        if batch_shape == ():
+            return dom_sim.sim(self,force)
         
-        reliability = 1 - np.sum(payoff_vector)
-        #print(payoff_vector[0:10])
-        if(reliability < 1):
-            mean_calc = [a*b for a,b in zip(payoff_vector,range(len(payoff_vector)))]
-            mean = np.sum(mean_calc) / (1-reliability)
-            sqmean_calc = [a*b for a,b in zip(mean_calc,range(len(mean_calc)))]
-            sqmean = np.sum(sqmean_calc) / (1-reliability)
-            stdev = sqmean - mean**2
-            
-            if stdev < 0:
-                stdev = 0 #necessary because sometimes rounding errors make it negative
+        results = np.full((3,) + batch_shape,np.nan)
+        missing = []
+        for k in range(batch_shape[0]):
+            point_results = None
+            if not (force or self.testing):
+                point_results = self.sink.lookup(self.batch_subset(k))
+                self.cache_stats['misses' if point_results is None else 'hits'] += 1
+            if point_results is None:
+                missing.append(k)
             else:
-                stdev = stdev ** 0.5
-            self.write_to_sql(mean,stdev,reliability)
-            return (mean, stdev, reliability)
-        else:
-            self.write_to_sql(0,0,reliability)
-            return (np.nan, np.nan, reliability)
+                results[:,k] = point_results
+        
+        errors = np.full((3,) + batch_shape,np.nan)
+        chunk = max(1,self.batch_elements // self.batch_subset(0).state_size())
+        for start in range(0,len(missing),chunk):
+            indices = np.array(missing[start:start+chunk])
+            subset = self.batch_subset(indices)
+            results[:,indices] = subset.simulate()
+            if extrapolate:
+                errors[:,indices] = subset.extrapolation_error
+        if extrapolate:
+            self.extrapolation_error = tuple(errors)
+        return tuple(results)
+    
+    #Number of entries in the state_vector of a single point
+    def state_size(self):
+        return self.parameters[0]
 
 #Simulates a lab/copper deck of infinite size
 class markov_lab_inf(markov_sim):
@@ -484,39 +1441,47 @@ class markov_lab_inf(markov_sim):
     #In this sim, state_vector represents p([0 labs in hand, 1 lab in hand, etc.])
     
     def __init__(self,fraction_labs,max_cards=1000):
-        if fraction_labs > 1:
+        if np.any(np.asarray(fraction_labs) > 1):
             raise ValueError("Error: expected fraction of labs less than 1")
             return
         self.parameters = [max_cards,fraction_labs]
         
     def init_prob(self):
         #The p_vector is the fraction of copper
-        self.p_vector = [1-self.parameters[1]]
-        
-        #draw_matrix modifies the state_vector when you draw a card
-        self.draw_matrix = np.matrix(np.zeros((self.parameters[0],self.parameters[0])))
-        np.fill_diagonal(self.draw_matrix,self.p_vector[0])
-        i = np.arange(self.parameters[0]-1)
-        self.draw_matrix[i+1,i] = 1-self.p_vector[0]
-        self.draw_matrix[self.parameters[0]-1,self.parameters[0]-1] = 1
-        
-        #play_matrix modifies the state_vector when you remove a lab from hand
-        #lab_matrix modifies the state_vector by playing a lab and drawing two cards.
-        play_matrix = np.matrix(np.zeros((self.parameters[0],self.parameters[0])))
-        play_matrix[i,i+1] = 1
-        self.lab_matrix = self.draw_matrix**2 * play_matrix
-    
-    #Plays a single action.  Returns probability of failure, and payoff in case of failure
+        self.p_vector = [self.batch_coefficient(1-np.asarray(self.parameters[1]))]
+        
+        #draw_matrix modifies the state_vector when you draw a card.  Drawing a copper keeps the state, drawing a lab moves it up one.
+        #The last state absorbs anything that reaches it.
+        self.draw_diag = np.ones(self.batch_shape + (self.parameters[0],)) * self.p_vector[0]
+        self.draw_diag[...,-1] = 1
+        self.draw_subdiag = 1-self.draw_diag[...,:-1]
+    
+    #The last state is where probability ends up when it reaches the card cap, so it isn't counted
+    def live_mass(self):
+        return np.sum(self.state_vector[...,:-1],axis=-1)
+    
+    def live_window(self):
+        return (0,min(self.hand_size + 1,self.state_vector.shape[-1]-1))
+    
+    #Each action changes the number of labs by -1 plus the number of labs in two draws.  This is gambler's ruin, and
+    #the probability of ever running out starting from k labs is exactly q**k, where q = ((1-L)/L)**2 (or 1 if L <= 1/2).
+    def ruin_bound(self):
+        fraction_labs = self.batch_coefficient(np.asarray(self.parameters[1],dtype=float))
+        with np.errstate(divide='ignore'):
+            q = np.minimum(((1-fraction_labs)/fraction_labs)**2,1)
+        return q**np.arange(self.parameters[0])
+    
+    #Plays a single action.  Fails if there are no labs in hand, with payoff equal to the hand size.
     def action(self):
-        p_failure = self.state_vector[0,0]
-        payoff = self.hand_size
-        self.state_vector = self.lab_matrix * self.state_vector
-        self.hand_size += 1
-        self.num_cards += 2
+        self.payoff_vector[...,self.hand_size] += self.state_vector[...,0]
         
-        failure_payoff = [0]*(self.parameters[0]+1)
-        failure_payoff[payoff] = p_failure
-        return failure_payoff
+        #Play a lab, which shifts the state_vector down by one (this replaces the play_matrix), and then draw two cards
+        window = min(self.hand_size + 1,self.state_vector.shape[-1])
+        self.state_vector[...,:window-1] = self.state_vector[...,1:window]
+        self.state_vector[...,window-1] = 0
+        self.hand_size -= 1
+        self.draw()
+        self.draw()
     
 #Simulates a lab/copper deck of finite size
 class markov_lab_fin(markov_lab_inf):
@@ -537,39 +1502,121 @@ class markov_lab_fin(markov_lab_inf):
         #p_vector is number of [=copper= in the starting deck
         self.p_vector = [self.parameters[0]-self.parameters[1]]
         
-        #play_matrix modifies the state_vector when you remove a lab from hand
-        self.play_matrix = np.matrix(np.zeros((self.parameters[0],self.parameters[0])))
-        i = np.arange(self.parameters[0]-1)
-        self.play_matrix[i,i+1] = 1
-        
-        #value of draw_matrix will be set later.
-        self.draw_matrix = np.matrix(np.zeros((self.parameters[0],self.parameters[0])))
+        #values of draw_diag and draw_subdiag will be set later.  lab_index is the number of labs in hand for each state.
+        self.lab_index = np.arange(self.parameters[0])
+        self.draw_diag = np.empty(self.parameters[0])
+        self.draw_subdiag = np.empty(self.parameters[0]-1)
+    
+    #Returns the number of cards and coppers in the pile being drawn from, counting the cards already drawn from it this turn.
+    #Here that's the whole deck.
+    def draw_pile(self):
+        return (self.parameters[0],self.p_vector[0])
     
     #calculates draw_matrix.  Returns false if deck is empty
     def calc_draw_matrix(self):
+        (pile_size,pile_coppers) = self.draw_pile()
         cards_in_play = self.num_cards - self.hand_size #cards in play
-        cards_in_deck = self.parameters[0] - self.num_cards
+        cards_in_deck = pile_size - self.num_cards
         if cards_in_deck == 0:
             #draw pile is empty
             return False
-        i = np.arange(self.parameters[0]-1)
-        self.draw_matrix[i,i] = (self.p_vector[0] - self.hand_size + i) / cards_in_deck
-        self.draw_matrix[i+1,i] = (self.parameters[0]-self.p_vector[0] - cards_in_play - i) / cards_in_deck
-        #print(self.draw_matrix[0,0])
+        #probability of drawing a copper (diagonal) or a lab (subdiagonal), given the number of labs in hand
+        #Only the states that draw() uses are updated, in place.
+        window = min(self.hand_size + 2,self.parameters[0])
+        diag = np.add(self.lab_index[:window],pile_coppers - self.hand_size,out=self.draw_diag[:window])
+        diag /= cards_in_deck
+        subdiag = np.subtract(pile_size-pile_coppers - cards_in_play,self.lab_index[:window-1],out=self.draw_subdiag[:window-1])
+        subdiag /= cards_in_deck
         return True
+
+#Simulates num_turns turns of a lab/copper deck of finite size.  Each turn draws from what's left of the draw pile, and when the
+#draw pile runs out, the discard pile is shuffled to make a new one.  At the end of each turn, the hand and play go to the discard pile.
+#The results are for the total payoff over all the turns.  reliability is always 0.
+#Between turns, the state is just the draw pile (number of cards, number of labs), since everything else is in the discard pile.
+#A turn from a draw pile of n cards with k labs draws through the pile, and then through the other D-n cards with L-k labs.
+#Playing labs draws two cards at a time, so the step where a turn fails sets both its payoff and the next draw pile.
+#So each draw pile has a small turn kernel, a list of (payoff, next draw pile, whether the whole deck was drawn, probability),
+#which is calculated once and cached in kernel_cache, and reused by every turn, and by any sim of the same deck.
+#After simulate(), turn_payoffs[t] is the payoff_vector of turn t alone, and fire_turns[t] is the probability that
+#turn t is the first to draw the whole deck.
+class markov_lab_turns(markov_lab_fin):
+    sim_type = "Markov Lab Finite Turns"
+    parameter_names = ["deck_size","num_labs","num_turns"]
+    is_finite = True
+    version = 2
+    kernel_cache = {}
+    
+    def __init__(self,num_labs,deck_size=30,num_turns=10):
+        markov_lab_fin.__init__(self,num_labs,deck_size)
+        self.parameters = [deck_size,num_labs,num_turns]
+        self.pile = (deck_size,num_labs)
+    
+    #Until the draw pile runs out, draws come from it.  Then they come from the reshuffled discard pile, which together with
+    #the cards drawn so far is the whole deck.
+    def draw_pile(self):
+        (pile_size,pile_labs) = self.pile
+        if self.num_cards < pile_size:
+            return (pile_size,pile_size-pile_labs)
+        return (self.parameters[0],self.p_vector[0])
     
+    #Records the probability of failing before playing the action, with the state of the deck at that point
     def action(self):
-        p_failure = self.state_vector[0,0]
-        payoff = self.hand_size
-        self.state_vector = self.play_matrix * self.state_vector
-        self.hand_size -= 1
-        
-        self.draw()
-        self.draw()
-        
-        failure_payoff = [0]*(self.parameters[0]+1)
-        failure_payoff[payoff] = p_failure
-        return failure_payoff
+        failed = self.state_vector[0]
+        if failed > 0:
+            self.outcomes.append((self.hand_size,self.next_pile(self.num_cards,self.num_cards-self.hand_size),False,failed))
+        markov_lab_fin.action(self)
+    
+    #The draw pile after a turn that drew num_cards cards, of which num_labs were labs.  An empty draw pile is the same
+    #as a freshly shuffled deck, including when the turn drew exactly the whole draw pile, since then the next turn
+    #reshuffles this turn's hand and play along with the discard pile.
+    def next_pile(self,num_cards,num_labs):
+        (pile_size,pile_labs) = self.pile
+        if num_cards < pile_size:
+            return (pile_size-num_cards,pile_labs-num_labs)
+        if pile_size < num_cards < self.parameters[0]:
+            return (self.parameters[0]-num_cards,self.parameters[1]-num_labs)
+        return (self.parameters[0],self.parameters[1])
+    
+    #Returns the turn kernel for a draw pile
+    def turn_kernel(self,pile):
+        key = (self.parameters[0],self.parameters[1],pile)
+        if key not in self.kernel_cache:
+            self.pile = pile
+            self.outcomes = []
+            markov_lab_fin.turn(self)
+            #whatever didn't fail drew the whole deck
+            p_draw_all = 1 - sum(outcome[3] for outcome in self.outcomes)
+            self.outcomes.append((self.p_vector[0],(self.parameters[0],self.parameters[1]),True,p_draw_all))
+            self.kernel_cache[key] = self.outcomes
+        return self.kernel_cache[key]
+    
+    #Steps the distribution of (draw pile, whether the whole deck has been drawn yet) through each turn,
+    #keeping the distribution of the total payoff so far for each.
+    def simulate(self):
+        (deck_size,num_labs,num_turns) = self.parameters
+        num_coppers = deck_size - num_labs
+        self.turn_payoffs = np.zeros((num_turns,num_coppers+1))
+        self.fire_turns = np.zeros(num_turns)
+        start = np.zeros(num_coppers*num_turns+1)
+        start[0] = 1
+        states = {((deck_size,num_labs),False):start}
+        for t in range(num_turns):
+            next_states = {}
+            for (pile,fired),totals in states.items():
+                mass = np.sum(totals)
+                for (payoff,next_pile,fire,prob) in self.turn_kernel(pile):
+                    self.turn_payoffs[t,payoff] += prob*mass
+                    if fire and not fired:
+                        self.fire_turns[t] += prob*mass
+                    key = (next_pile,fired or fire)
+                    if key not in next_states:
+                        next_states[key] = np.zeros(len(start))
+                    next_states[key][payoff:] += prob*totals[:len(start)-payoff]
+            states = next_states
+        payoff_vector = sum(states.values())
+        (mean,stdev,reliability) = self.payoff_stats(payoff_vector)
+        self.write_results(mean,stdev,reliability,payoff_vector)
+        return (mean,stdev,reliability)
 
 #Simulates a village/smithy/copper deck of infinite size
 class markov_vsm_inf(markov_sim):
@@ -583,70 +1630,158 @@ class markov_vsm_inf(markov_sim):
     #It is assumed that villages are played immediately
     #unless there are no actions available to play them in which case it doesn't really matter whether it's a village or smithy
     
+    #Only the columns from window_lo to window_hi (exclusive) can be nonzero, and the rest of the state_vector is skipped.
+    #If prune_epsilon is positive, columns at the edges of the window with less than prune_epsilon probability are discarded after every action.
+    #discarded_mass is the total probability discarded this way, which is an upper bound on the error in reliability.
+    prune_epsilon = 0
+    
+    exact_settings = dict(markov_sim.exact_settings,prune_epsilon=0)
+    
     def __init__(self,fraction_villages,fraction_smithies,max_cards=1000,max_actions=40):
-        if fraction_villages + fraction_smithies > 1:
+        if np.any(np.asarray(fraction_villages) + np.asarray(fraction_smithies) > 1):
             raise ValueError("Error: expected fraction of action cards less than 1")
             return
         self.parameters = [max_cards,max_actions,fraction_villages,fraction_smithies]
     
     #Initializes parameters for the start of turn.
     def markov_init(self):
+        self.batch_shape = self.get_batch_shape()
         self.num_cards = 0 #number of cards in hand and play.  Used to limit simulation length.
         self.hand_size = 0 #number of cards in hand.  Used to infer number of coppers in hand.
         
-        self.state_vector = np.matrix(np.zeros((self.parameters[1],self.parameters[0])))
-        self.state_vector[1,0] = 1
+        self.state_vector = np.zeros(self.batch_shape + (self.parameters[1],self.parameters[0]))
+        self.state_vector[...,1,0] = 1
+        self.window_lo = 0
+        self.window_hi = 1
+        self.discarded_mass = np.zeros(self.batch_shape)
         
         self.init_prob()
+    
+    def live_mass(self):
+        window = self.state_vector[...,self.window_lo:self.window_hi]
+        return np.sum(np.reshape(window,self.batch_shape + (-1,)),axis=-1)
+    
+    def state_size(self):
+        return self.parameters[0]*self.parameters[1]
+    
+    def live_window(self):
+        return (self.window_lo,self.window_hi)
+    
+    #The turn fails if it runs out of either smithies or actions, so the ruin probability is at most the sum of the two.
+    #Each draw is a run of villages followed by a copper or smithy.  So per smithy played, the number of smithies changes by
+    #-1 plus Binomial(3,s), where s = S/(1-V), and the actions left after playing it change by -1 plus the villages in 3 runs.
+    #Both are skip-free random walks, so running out from c smithies has probability q**c, where q = (1-s+s*q)**3,
+    #and running out from a actions has probability t**(a-1), where t = ((1-V)/(1-V*t))**3 (taking the smallest roots).
+    #This ignores the cap on the action supply, which is assumed to be large enough that t**(max_actions-2) is negligible.
+    def ruin_bound(self):
+        fraction_villages = self.batch_coefficient(np.asarray(self.parameters[2],dtype=float),2)
+        fraction_smithies = self.batch_coefficient(np.asarray(self.parameters[3],dtype=float),2)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            s = np.where(fraction_villages < 1,fraction_smithies/(1-fraction_villages),0)
+            #q = 1 is always a root, and factoring it out of the cubic leaves a quadratic
+            q = np.where(s > 1/3,1 + (np.sqrt((4-3*s)/s) - 3)/(2*s),1)
+        
+        #t*(1-V*t)**3 - (1-V)**3 increases up to t = 1/(4V) and then decreases to 0 at t = 1.  If V > 1/4, the root we want
+        #is below 1/(4V), and found by bisection.  The upper end of the bracket is kept, so that this stays an upper bound.
+        supercritical = fraction_villages > 1/4
+        lower = np.zeros(fraction_villages.shape)
+        upper = np.where(supercritical,1/(4*np.maximum(fraction_villages,1/4)),1)
+        for i in range(60):
+            middle = (lower + upper)/2
+            above = middle*(1-fraction_villages*middle)**3 >= (1-fraction_villages)**3
+            upper = np.where(supercritical & above,middle,upper)
+            lower = np.where(supercritical & ~above,middle,lower)
+        t = upper
+        
+        actions = np.arange(self.parameters[1])[:,np.newaxis]
+        smithies = np.arange(self.parameters[0])
+        ruin = np.minimum(t**np.maximum(actions-1,0) + q**smithies,1)
+        ruin[...,0,:] = 1
+        return ruin
         
     #initializes the p_vector and draw_matrix and anything else related to probabilities
     def init_prob(self):
         #p_vector is [p(copper),p(village)]
-        self.p_vector = [1-self.parameters[3]-self.parameters[2],self.parameters[2]]
+        self.p_vector = [self.batch_coefficient(1-np.asarray(self.parameters[3])-self.parameters[2],2),self.batch_coefficient(self.parameters[2],2)]
         
         #draw_matrix would be a rank 4 tensor, and too large to contain in memory.  So I do something different
         #action_matrix modifies your action pool upon draw, assuming that you immediately play any villages (if able)
-        self.action_matrix = np.matrix(np.zeros((self.parameters[1],self.parameters[1])))
-        
-        i,j=np.indices(self.action_matrix.shape)
+        i,j=np.indices((self.parameters[1],self.parameters[1]))
         #probabilities for number of consecutive villages
-        self.action_matrix[i >= j] = (1-self.p_vector[1])*(self.p_vector[1]**(i[i >= j]-j[i >= j]))
+        self.action_matrix = np.where(i >= j,(1-self.p_vector[1])*(self.p_vector[1]**np.maximum(i-j,0)),0)
         #the action supply maxes out to save computing time
-        self.action_matrix[-1,:] = self.p_vector[1]**(self.parameters[1]-np.arange(self.parameters[1])-1)
+        self.action_matrix[...,-1,:] = self.p_vector[1][...,0]**(self.parameters[1]-np.arange(self.parameters[1])-1)
         #If there are no actions remaining, you can't immediately play villages.
-        self.action_matrix[1:,0] = 0
-        self.action_matrix[0,0] = 1
+        self.action_matrix[...,1:,0] = 0
+        self.action_matrix[...,0,0] = 1
+        
+        #After villages are played, the next card is a copper or smithy (draw_stay or draw_shift), for each action supply
+        #Need to specially handle the case where the action pool is empty, since villages cannot be played immediately
+        self.draw_stay = np.ones(self.batch_shape + (self.parameters[1],1)) * self.p_vector[0]/(1-self.p_vector[1])
+        self.draw_shift = np.ones(self.batch_shape + (self.parameters[1],1)) * (1-self.p_vector[0]-self.p_vector[1])/(1-self.p_vector[1])
+        self.draw_stay[...,0,:] = self.p_vector[0][...,0,:]
+        self.draw_shift[...,0,:] = 1-self.p_vector[0][...,0,:]
         
+    #Only the window is updated.  A draw can move probability up one column, so the window grows by one.
     def draw(self):
+        self.window_hi = min(self.window_hi + 1,self.parameters[0])
         #First modify the action pool
-        self.state_vector = self.action_matrix * self.state_vector
-        #Next modify the number of non-coppers in hand.
-        self.state_vector[1:,1:] = self.state_vector[1:,1:]*self.p_vector[0]/(1-self.p_vector[1]) + self.state_vector[1:,:-1]*(1-self.p_vector[0]-self.p_vector[1])/(1-self.p_vector[1])
-        self.state_vector[1:,0] *= self.p_vector[0]/(1-self.p_vector[1])
-        #Need to specially handle the case where the action pool is empty, since villages cannot be played immediately
-        self.state_vector[0,1:] = self.state_vector[0,1:]*self.p_vector[0] + self.state_vector[0,:-1]*(1-self.p_vector[0])
-        self.state_vector[0,0] *= self.p_vector[0]
+        state = self.state_vector[...,self.window_lo:self.window_hi]
+        state[...] = np.matmul(self.action_matrix,state)
+        #Next modify the number of non-coppers in hand.  Each row either keeps its column (drawing a copper) or moves up one (drawing a smithy)
+        moved = self.draw_shift * state[...,:-1]
+        state *= self.draw_stay
+        state[...,1:] += moved
         
         self.num_cards += 1
         self.hand_size += 1
         
     
-    #Plays a single smithy, and returns probability that no smithies can be played, along with the payoff probabilities.
+    #Plays a single smithy, and adds the probability that no smithies can be played to payoff_vector.
     def action(self):
-        failure_payoff = np.zeros((self.parameters[0]+1))
-        #If there are no smithies, then it fails
-        failure_payoff[self.hand_size] = np.sum(self.state_vector[:,0])
-        #If there are no remaining actions, then it fails
-        failure_payoff[:self.hand_size] = np.add(failure_payoff[:self.hand_size],self.state_vector[0,self.hand_size:0:-1])
-        
-        #Play a smithy, spending a card and an action
-        self.state_vector[:-1,:-1] = self.state_vector[1:,1:]
-        self.state_vector[-1,:] = 0
-        self.state_vector[:,-1] = 0
+        if self.window_lo == 0 and self.window_hi > 0:
+            #If there are no smithies, then it fails
+            self.payoff_vector[...,self.hand_size] += np.sum(self.state_vector[...,:,0],axis=-1)
+        
+        lo = max(self.window_lo,1)
+        hi = self.window_hi
+        if hi > lo:
+            #If there are no remaining actions, then it fails.  The payoff is the number of coppers, i.e. hand_size minus the column.
+            self.payoff_vector[...,self.hand_size-hi+1:self.hand_size-lo+1] += self.state_vector[...,0,hi-1:lo-1:-1]
+            
+            #Play a smithy, spending a card and an action
+            self.state_vector[...,:-1,lo-1:hi-1] = self.state_vector[...,1:,lo:hi]
+            self.state_vector[...,-1,lo-1:hi-1] = 0
+            self.state_vector[...,:,hi-1] = 0
+            self.window_lo = lo-1
+            self.window_hi = hi-1
+        else:
+            #There is nothing left, except possibly column 0, which has just failed
+            self.state_vector[...,:,:hi] = 0
+            self.window_lo = 0
+            self.window_hi = 0
         self.hand_size -= 1
         
+        if self.prune_epsilon > 0:
+            self.prune()
+        
         self.draw()
         self.draw()
         self.draw()
-        
-        return failure_payoff
\ No newline at end of file
+    
+    #Discards columns at the edges of the window that have less than prune_epsilon probability (in every point of the batch)
+    def prune(self):
+        window = self.state_vector[...,self.window_lo:self.window_hi]
+        column_mass = np.sum(window,axis=-2)
+        largest = np.reshape(column_mass,(-1,column_mass.shape[-1])).max(axis=0)
+        keep = np.flatnonzero(largest >= self.prune_epsilon)
+        if len(keep) == 0:
+            lo = hi = 0
+        else:
+            lo = keep[0]
+            hi = keep[-1] + 1
+        self.discarded_mass += np.sum(column_mass[...,:lo],axis=-1) + np.sum(column_mass[...,hi:],axis=-1)
+        window[...,:lo] = 0
+        window[...,hi:] = 0
+        self.window_hi = self.window_lo + hi
+        self.window_lo = self.window_lo + lo
\ No newline at end of file
@@ -0,0 +1,245 @@
+'''
+Dominion Markov
+Author: Tristan Miller
+This contains a benchmark suite, which times the Monte Carlo and Markov sims on a fixed set of scenarios
+'''
+import numpy as np
+from numpy import random
+import time
+import json
+import csv
+import tracemalloc
+import sys
+from dominionMarkov import monte_lab_inf, monte_lab_fin, monte_vsm_inf, monte_herald_inf, markov_lab_inf, markov_lab_fin, markov_vsm_inf, monte_lab_turns, markov_lab_turns, uniform_stream
+from dominionKernels import compiled_backend
+
+#Each scenario is a dict with:
+#name: unique name, used to match results against the baseline
+#size: 'small' or 'large'.  The small scenarios take a few seconds altogether.
+#sim_class and arguments: the sim being timed
+#reference: optional (markov class, arguments) whose results are used to measure accuracy.
+#Monte Carlo scenarios are compared against the Markov sim with the same card cap, so the error is the sampling error.
+#The Markov village/smithy scenario with a smaller action cap is compared against the default action cap.
+def lab_reference(max_cards):
+    return (markov_lab_inf,{'fraction_labs':.45,'max_cards':max_cards})
+def vsm_reference(max_cards):
+    return (markov_vsm_inf,{'fraction_villages':.3,'fraction_smithies':.3,'max_cards':max_cards})
+lab_fin_reference = (markov_lab_fin,{'num_labs':15,'deck_size':30})
+scenarios = [
+    {'name':'monte_lab_inf_200_1000','size':'small','sim_class':monte_lab_inf,
+        'arguments':{'fraction_labs':.45,'max_cards':200,'num_sims':1000},'reference':lab_reference(200)},
+    {'name':'monte_lab_inf_1000_10000','size':'large','sim_class':monte_lab_inf,
+        'arguments':{'fraction_labs':.45,'max_cards':1000,'num_sims':10000},'reference':lab_reference(1000)},
+    {'name':'markov_lab_inf_200','size':'small','sim_class':markov_lab_inf,
+        'arguments':{'fraction_labs':.45,'max_cards':200},'reference':None},
+    {'name':'markov_lab_inf_2000','size':'large','sim_class':markov_lab_inf,
+        'arguments':{'fraction_labs':.45,'max_cards':2000},'reference':None},
+    {'name':'monte_lab_fin_30_1000','size':'small','sim_class':monte_lab_fin,
+        'arguments':{'num_labs':15,'deck_size':30,'num_sims':1000},'reference':lab_fin_reference},
+    {'name':'monte_lab_fin_30_10000','size':'large','sim_class':monte_lab_fin,
+        'arguments':{'num_labs':15,'deck_size':30,'num_sims':10000},'reference':lab_fin_reference},
+    {'name':'markov_lab_fin_30','size':'small','sim_class':markov_lab_fin,
+        'arguments':{'num_labs':15,'deck_size':30},'reference':None},
+    {'name':'monte_vsm_inf_200_1000','size':'small','sim_class':monte_vsm_inf,
+        'arguments':{'fraction_villages':.3,'fraction_smithies':.3,'max_cards':200,'num_sims':1000},'reference':vsm_reference(200)},
+    {'name':'monte_vsm_inf_1000_10000','size':'large','sim_class':monte_vsm_inf,
+        'arguments':{'fraction_villages':.3,'fraction_smithies':.3,'max_cards':1000,'num_sims':10000},'reference':vsm_reference(1000)},
+    {'name':'markov_vsm_inf_200_20','size':'small','sim_class':markov_vsm_inf,
+        'arguments':{'fraction_villages':.3,'fraction_smithies':.3,'max_cards':200,'max_actions':20},'reference':vsm_reference(200)},
+    {'name':'markov_vsm_inf_1000_40','size':'large','sim_class':markov_vsm_inf,
+        'arguments':{'fraction_villages':.3,'fraction_smithies':.3,'max_cards':1000,'max_actions':40},'reference':None},
+    {'name':'monte_herald_inf_200_1000','size':'small','sim_class':monte_herald_inf,
+        'arguments':{'fraction_heralds':.5,'max_cards':200,'num_sims':1000},'reference':None},
+    {'name':'monte_herald_inf_1000_10000','size':'large','sim_class':monte_herald_inf,
+        'arguments':{'fraction_heralds':.5,'max_cards':1000,'num_sims':10000},'reference':None},
+    ]
+
+#Times the given scenarios.  Each sim is run warmups times first.  The sims are then timed in rounds, running each sim in
+#every round until its runs in that round add up to min_total/rounds seconds (and at least once).  Spreading each sim's
+#repeats over the whole benchmark means that a few seconds when the machine is slow don't affect all of them.
+#Peak memory is measured on a separate run, started from the seed again, since tracemalloc slows things down.  Nothing is written to the database.
+#Returns a list of dicts of the timings and the results of that separate run.
+def time_scenarios(selected,warmups=1,rounds=5,min_total=.5,seed=0):
+    sims = []
+    for scenario in selected:
+        sim = scenario['sim_class'](**scenario['arguments'])
+        sim.testing = True
+        random.seed(seed)
+        for i in range(warmups):
+            sim.sim()
+        sims.append(sim)
+    times = [[] for sim in sims]
+    for i in range(rounds):
+        for k in range(len(sims)):
+            round_time = 0
+            while round_time == 0 or round_time < min_total/rounds:
+                start_time = time.perf_counter()
+                sims[k].sim()
+                times[k].append(time.perf_counter() - start_time)
+                round_time += times[k][-1]
+    records = []
+    for (scenario,sim,sim_times) in zip(selected,sims,times):
+        #the results are from a separate run, so that they don't depend on how many times the sim was timed
+        random.seed(seed)
+        tracemalloc.start()
+        (mean,stdev,reliability) = sim.sim()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        records.append({'name':scenario['name'],
+                        'sim_type':sim.sim_type,
+                        'arguments':scenario['arguments'],
+                        'min_time':min(sim_times),
+                        'median_time':float(np.median(sim_times)),
+                        'mean_time':float(np.mean(sim_times)),
+                        'spread':float(np.percentile(sim_times,10)) - min(sim_times),
+                        'repeats':len(sim_times),
+                        'peak_memory':peak_memory,
+                        'mean':float(mean),
+                        'stdev':float(stdev),
+                        'reliability':float(reliability)})
+    return records
+
+#Runs every scenario of the given sizes (or only the given names), and returns a list of results.
+#Where a scenario has a reference, error_mean, error_stdev and error_reliability are the differences from the reference results.
+def run_benchmark(sizes=('small','large'),names=None,warmups=1,rounds=5,seed=0):
+    selected = [scenario for scenario in scenarios
+                if scenario['size'] in sizes and (names is None or scenario['name'] in names)]
+    references = {}
+    records = time_scenarios(selected,warmups,rounds,seed=seed)
+    for (scenario,record) in zip(selected,records):
+        record['error_mean'] = record['error_stdev'] = record['error_reliability'] = np.nan
+        if scenario['reference'] is not None:
+            (reference_class,reference_arguments) = scenario['reference']
+            key = (reference_class.sim_type,json.dumps(reference_arguments,sort_keys=True))
+            if key not in references:
+                reference = reference_class(**reference_arguments)
+                reference.testing = True
+                references[key] = reference.sim()
+            (mean,stdev,reliability) = references[key]
+            record['error_mean'] = record['mean'] - float(mean)
+            record['error_stdev'] = record['stdev'] - float(stdev)
+            record['error_reliability'] = record['reliability'] - float(reliability)
+        print('%-30s %10.4f s %12d bytes' % (record['name'],record['median_time'],record['peak_memory']))
+    return records
+
+def write_json(records,filename):
+    with open(filename,'w') as f:
+        json.dump(records,f,indent=1)
+
+def read_json(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def write_csv(records,filename):
+    fields = list(records[0].keys())
+    with open(filename,'w',newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=fields)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(dict(record,arguments=json.dumps(record['arguments'],sort_keys=True)))
+
+#Compares records against a baseline (a list of records, e.g. from read_json), matching scenarios by name.
+#Times are compared by the fastest run (min_time), which is the least affected by noise from the rest of the machine.
+#The noise in each min_time is measured by the spread of its fastest repeats (the 10th percentile minus min_time).
+#A scenario regresses if its time grew by more than noise_factor times the spreads of both runs added together, and by
+#more than time_tolerance (as a fraction of the baseline), or if the size of any of its errors grew by more than error_tolerance.
+#Prints a table, and returns a list of dicts of the comparisons.
+def compare_baseline(records,baseline,noise_factor=1,time_tolerance=.1,error_tolerance=.05):
+    baseline = {record['name']:record for record in baseline}
+    comparisons = []
+    for record in records:
+        if record['name'] not in baseline:
+            continue
+        old = baseline[record['name']]
+        time_ratio = record['min_time'] / old['min_time']
+        regressed = (time_ratio > 1 + time_tolerance and
+                     record['min_time'] - old['min_time'] > noise_factor*(record['spread'] + old['spread']))
+        for error in ['error_mean','error_stdev','error_reliability']:
+            if abs(record[error]) > abs(old[error]) + error_tolerance:
+                regressed = True
+        comparisons.append({'name':record['name'],
+                            'baseline_time':old['min_time'],
+                            'min_time':record['min_time'],
+                            'time_ratio':time_ratio,
+                            'memory_ratio':record['peak_memory'] / max(old['peak_memory'],1),
+                            'regressed':regressed})
+        print('%-30s %10.4f s %10.4f s %7.2fx %s' % (record['name'],old['min_time'],record['min_time'],time_ratio,
+                                                    'REGRESSED' if regressed else ''))
+    return comparisons
+
+#Checks that the turn kernels (see monte_sim.kernel_turn) give the same results as the batched engine, and times them.
+#Every Monte Carlo scenario with a kernel is run with each backend, on the same common random numbers, so the results
+#should be bit-identical.  The 'kernel' backend is compiled if numba is installed (compiled_backend is 'numba'),
+#and is run once first, so that compilation isn't timed.  The times include generating the random numbers.
+#Returns a list of dicts with the turns per second of each backend, the speedup of each backend over 'numpy',
+#and whether the results were identical.
+def kernel_parity(sizes=('small',),backends=('numpy','kernel','python'),seed=0):
+    records = []
+    print('kernels compiled with: %s' % compiled_backend)
+    for scenario in scenarios:
+        sim_class = scenario['sim_class']
+        if scenario['size'] not in sizes or getattr(sim_class,'kernel',None) is None:
+            continue
+        record = {'name':scenario['name'],'compiled_backend':compiled_backend}
+        results = []
+        for backend in backends:
+            sim = sim_class(**scenario['arguments'])
+            sim.testing = True
+            if backend == 'kernel':
+                sim.sim(force=True,common_stream=uniform_stream(seed),backend=backend)
+            start_time = time.perf_counter()
+            results.append(sim.sim(force=True,common_stream=uniform_stream(seed),backend=backend))
+            record[backend + '_turns_per_second'] = sim.turns_used / (time.perf_counter() - start_time)
+        if 'numpy' in backends:
+            for backend in backends:
+                record[backend + '_speedup'] = record[backend + '_turns_per_second'] / record['numpy_turns_per_second']
+        record['identical'] = all(np.array_equal(result,results[0],equal_nan=True) for result in results)
+        records.append(record)
+        print('%-30s %s' % (record['name'],' '.join('%s %10.0f/s (%.2fx)' % (backend,record[backend + '_turns_per_second'],
+                                                                             record.get(backend + '_speedup',np.nan)) for backend in backends)),
+              '' if record['identical'] else 'MISMATCH')
+    return records
+
+#Checks the multi-turn Markov sim against the multi-turn Monte Carlo sim, on decks where turns often end having drawn exactly
+#the whole draw pile, so that the next turn has to reshuffle the whole deck.
+#Returns a list of dicts with the z-score of each Monte Carlo mean, which should be small.
+turns_decks = [{'num_labs':5,'deck_size':20,'num_turns':3},{'num_labs':10,'deck_size':30,'num_turns':10}]
+def turns_check(num_sims=40000,seed=1,max_z=4):
+    records = []
+    for deck in turns_decks:
+        markov = markov_lab_turns(**deck)
+        markov.testing = True
+        monte = monte_lab_turns(num_sims=num_sims,**deck)
+        monte.testing = True
+        (markov_mean,markov_stdev,markov_reliability) = markov.sim()
+        (monte_mean,monte_stdev,monte_reliability) = monte.sim(force=True,seed=seed)
+        z = (monte_mean - markov_mean) / (monte_stdev / np.sqrt(num_sims))
+        records.append({'arguments':deck,'markov_mean':float(markov_mean),'monte_mean':float(monte_mean),'z':float(z),'passed':abs(z) < max_z})
+        print('%-50s %10.4f %10.4f %7.2f %s' % (json.dumps(deck,sort_keys=True),markov_mean,monte_mean,z,'' if abs(z) < max_z else 'MISMATCH'))
+    return records
+
+#e.g. python simBenchmark.py small results.json baseline.json
+#runs the small scenarios, writes results.json (and results.csv), and compares against baseline.json if given.
+#Scenarios that regress are timed again (up to 3 more times), and only fail if they regress every time, since the whole
+#machine sometimes slows down for several seconds, which no spread between the repeats of one scenario can show.
+#python simBenchmark.py parity checks the turn kernels against the batched engine (see kernel_parity)
+#python simBenchmark.py turns checks the multi-turn sims against each other (see turns_check)
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'parity':
+        sys.exit(0 if all(record['identical'] for record in kernel_parity()) else 1)
+    if len(sys.argv) >= 2 and sys.argv[1] == 'turns':
+        sys.exit(0 if all(record['passed'] for record in turns_check()) else 1)
+    sizes = ('small','large') if len(sys.argv) < 2 or sys.argv[1] == 'all' else (sys.argv[1],)
+    records = run_benchmark(sizes)
+    if len(sys.argv) >= 3:
+        write_json(records,sys.argv[2])
+        write_csv(records,sys.argv[2].rsplit('.',1)[0] + '.csv')
+    if len(sys.argv) >= 4:
+        baseline = read_json(sys.argv[3])
+        names = [c['name'] for c in compare_baseline(records,baseline) if c['regressed']]
+        for attempt in range(3):
+            if len(names) == 0:
+                break
+            print('timing the regressed scenarios again')
+            names = [c['name'] for c in compare_baseline(run_benchmark(sizes,names),baseline) if c['regressed']]
+        sys.exit(1 if len(names) > 0 else 0)
@@ -13,6 +13,7 @@ import time
 #import sys
 #import re
 import sqlite3 as lite
+from dominionMarkov import init_sql_indexes, init_sql_distributions, decode_distribution
 
 #Note: SQL has the following tables
 '''sim_types(id integer primary key,
@@ -35,7 +36,82 @@ import sqlite3 as lite
             stdev real,
             mean real,
             reliability real,
-            deleted bit)'''
+            deleted bit)
+  sim_distributions(result_id integer primary key references sim_results(id),
+            length integer,
+            data blob)'''
+
+#Loads results from a two-parameter sim in a single query, and averages them over a density x density grid.
+#Rows are binned by p2 (grid rows) and p3 (grid columns), with bins [i/density, (i+1)/density).
+#Returns grids of the average mean, reliability, stdev and p0, which are nan where a bin has no results.
+def load_grid(sim_type_id,density,min_p0=0):
+    con = lite.connect('sim.db')
+    init_sql_indexes(con)
+    with con:
+        cur = con.cursor()
+        cmd = '''select mean,reliability,stdev,p0,p2,p3
+            from sim_results
+            where sim_type_id = ?
+            and deleted = 0
+            and p0 >= ?'''
+        cur.execute(cmd,(sim_type_id,min_p0))
+        results = np.array(cur.fetchall(),dtype=float).reshape(-1,6)
+    con.close()
+    
+    #bin edges are rounded to 3 decimal places
+    edges = np.array(['%.3f' % (i/density) for i in range(density+1)],dtype=float)
+    i = np.digitize(results[:,4],edges) - 1
+    j = np.digitize(results[:,5],edges) - 1
+    in_grid = (i >= 0) & (i < density) & (j >= 0) & (j < density)
+    cell = i[in_grid]*density + j[in_grid]
+    
+    counts = np.bincount(cell,minlength=density**2)
+    grids = []
+    for column in range(4):
+        sums = np.bincount(cell,weights=results[in_grid,column],minlength=density**2)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            grid = sums/counts
+        grid[counts == 0] = np.nan
+        grids.append(grid.reshape((density,density)))
+    return grids
+
+#Loads the payoff distribution stored with a row of sim_results, as an array of the probability of each payoff.
+#Returns None if the row has no distribution.
+def load_distribution(result_id):
+    con = lite.connect('sim.db')
+    init_sql_distributions(con)
+    row = con.execute('select data from sim_distributions where result_id = ?',(result_id,)).fetchone()
+    con.close()
+    return None if row is None else decode_distribution(row[0])
+
+#Loads every stored distribution of a sim type in a single query.
+#Returns (results, distributions), where results is an array with a row of (id,p0,p1,p2,p3,p4,mean,stdev,reliability)
+#for each distribution, and distributions is a list of arrays.
+def load_distributions(sim_type_id,min_p0=0):
+    con = lite.connect('sim.db')
+    init_sql_distributions(con)
+    with con:
+        cur = con.cursor()
+        cmd = '''select r.id,r.p0,r.p1,r.p2,r.p3,r.p4,r.mean,r.stdev,r.reliability,d.data
+            from sim_results r join sim_distributions d on d.result_id = r.id
+            where r.sim_type_id = ?
+            and r.deleted = 0
+            and r.p0 >= ?'''
+        cur.execute(cmd,(sim_type_id,min_p0))
+        rows = cur.fetchall()
+    con.close()
+    results = np.array([row[:9] for row in rows],dtype=float).reshape(-1,9)
+    distributions = [decode_distribution(row[9]) for row in rows]
+    return (results,distributions)
+
+#Stacks distributions into a single 2-d array, padding with zeros, so that statistics can be computed for all of them at once.
+#e.g. the probability of a payoff of at least 8 is np.sum(stack_distributions(distributions)[:,8:],axis=1)
+def stack_distributions(distributions):
+    length = max([len(distribution) for distribution in distributions] + [0])
+    stacked = np.zeros((len(distributions),length))
+    for k in range(len(distributions)):
+        stacked[k,:len(distributions[k])] = distributions[k]
+    return stacked
 
 #I'm only making a few figures, so these are pretty much ad hoc functions
 def lab_sim_fig():
@@ -151,45 +227,17 @@ def lab_fin_fig():
     
     plt.title('Lab deck with 15 Copper',fontsize=24)
     
-def vsm_sim_fig():
-    #Initialize arrays
+#boundary is an optional list of cells along the phase boundary, from simSweep.find_boundary with x=fraction_smithies
+#and y=fraction_villages.  If given, their centers are plotted instead of the idealized critical line.
+def vsm_sim_fig(boundary=None):
     density = 100
-    mean = np.zeros((density,density))
-    mean_dud = np.zeros((density,density))
-    stdev = np.zeros((density,density))
-    reliability = np.zeros((density,density))
-    mean[:] = np.nan
-    mean_dud[:] = np.nan
-    stdev[:] = np.nan
-    reliability[:] = np.nan
-    
     i,j = np.indices((density,density))
     V_coord = i/density
     S_coord = j/density
     
     #get data from database
-    con = lite.connect('sim.db')
-    with con:
-        cur = con.cursor()
-        for i,j in np.ndindex((density,density)):
-            
-            cmd = '''select avg(mean),avg(reliability),avg(stdev),avg(p0)
-                from sim_results
-                where sim_type_id = 7
-                and deleted = 0
-                and p0 >= 1000
-                and p2 >= %.3f and p2 < %.3f
-                and p3 >= %.3f and p3 < %.3f''' % (i/density,(i+1)/density,j/density,(j+1)/density)
-            cur.execute(cmd)
-            results = cur.fetchone()
-            
-            if results[0] is not None:
-                reliability[i,j] = results[1]
-                mean[i,j] = results[0]*(1-results[1]) + results[3]*results[1]
-                mean_dud[i,j] = results[0]
-                stdev[i,j] = results[2]
-            
-    con.close()
+    (mean_dud,reliability,stdev,max_cards) = load_grid(7,density,min_p0=1000)
+    mean = mean_dud*(1-reliability) + max_cards*reliability
     
     #Separate out the subcritical and supercritical parts
     sub_mean = mean
@@ -199,7 +247,11 @@ def vsm_sim_fig():
     critical_S = np.array([0,.25,.75])
     critical_V = np.array([1,.25,.25])
     fig, ax = plt.subplots(figsize=(20,10))
-    ax.plot(critical_S,critical_V,lw=3,linestyle="dashed",color='w')
+    if boundary is None:
+        ax.plot(critical_S,critical_V,lw=3,linestyle="dashed",color='w')
+    else:
+        cells = np.array(boundary)
+        ax.scatter((cells[:,0]+cells[:,2])/2,(cells[:,1]+cells[:,3])/2,s=4,color='w')
     
     c1 = ax.imshow(sub_mean,extent=(0,1,0,1),origin='lower',interpolation='none',cmap=plt.cm.plasma_r)
     c2 = ax.imshow(reliability,extent=(0,1,0,1),origin='lower',interpolation='none',cmap=plt.cm.winter_r)
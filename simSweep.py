@@ -0,0 +1,246 @@
+'''
+Dominion Markov
+Author: Tristan Miller
+This contains code to run simulations over a grid of parameters, in parallel and resumably, and to trace phase boundaries
+'''
+import numpy as np
+import itertools
+import json
+import sqlite3 as lite
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dominionMarkov import result_sink, uniform_stream
+
+#Note: in addition to sim_types and sim_results, sweeps use the following table
+'''sweep_jobs(id integer primary key,
+            sim_type text,
+            sim_version integer,
+            arguments text,
+            status text,
+            unique(sim_type, sim_version, arguments))'''
+#arguments are the keyword arguments of the sim constructor, encoded as json
+#status is 'pending', 'running' or 'done'
+
+#Creates the job table, if it isn't already in the database
+def init_sweep_table():
+    con = lite.connect('sim.db')
+    with con:
+        cur = con.cursor()
+        sqlcmd = '''
+        create table if not exists sweep_jobs(
+            id integer primary key,
+            sim_type text,
+            sim_version integer,
+            arguments text,
+            status text,
+            unique(sim_type, sim_version, arguments))'''
+        cur.execute(sqlcmd)
+    con.close()
+
+#Makes a list of parameter points out of every combination of the given values, e.g.
+#grid_points(fraction_villages=np.arange(0,1,.01),fraction_smithies=np.arange(0,1,.01),max_cards=1000)
+#condition is an optional function that takes a point and returns whether to keep it.
+def grid_points(condition=None,**axes):
+    names = list(axes.keys())
+    values = [np.atleast_1d(axes[name]).tolist() for name in names]
+    points = [dict(zip(names,combination)) for combination in itertools.product(*values)]
+    if condition is not None:
+        points = [point for point in points if condition(point)]
+    return points
+
+#json encoding of a point, used as the key in the job table.  numpy numbers are converted to python numbers first.
+def encode_point(point):
+    point = {name:(value.item() if isinstance(value,np.generic) else value) for name,value in point.items()}
+    return json.dumps(point,sort_keys=True)
+
+#Runs a single point in a worker process.  The result is written to the database by the main process.
+#With profile=True, also returns the sim's profile report.
+def run_job(sim_class,arguments,profile=False):
+    sim = sim_class(**json.loads(arguments))
+    sim.testing = True
+    if not profile:
+        return sim.sim()
+    sim.enable_profiling()
+    results = sim.sim()
+    return (results,sim.profile_report())
+
+#Marks the given jobs as finished
+def mark_done(con,job_ids):
+    with con:
+        con.executemany("update sweep_jobs set status = 'done' where id = ?", [(job_id,) for job_id in job_ids])
+
+#Runs sim_class at every point (a list of dicts of constructor arguments), using a pool of worker processes.
+#Points are recorded in the sweep_jobs table, so if the sweep is interrupted, running it again skips the finished points.
+#Jobs still marked 'running' are assumed to have been interrupted, and are run again.
+#workers is the number of processes (default is the number of cpus)
+#Results are written in batches of flush_size, or every flush_interval seconds.  A job is only marked done once its result is written.
+#Points whose results are already in the database are looked up instead of simulated, and marked done.
+#Returns a list of (point, results) for the points finished by this call, whether looked up or simulated.
+#If profiles is a list, each job is profiled, and its report is appended (see dom_sim.profile_report and aggregate_profiles).
+#Jobs are recorded under the name results are stored under (see dom_sim.result_type), so sweeps of a sim with approximations
+#turned on are kept apart from exact sweeps.  Approximations are set on the class, so every point has the same name.
+def run_sweep(sim_class,points,workers=None,flush_size=100,flush_interval=10,profiles=None):
+    init_sweep_table()
+    sim_type = sim_class(**points[0]).result_type() if len(points) > 0 else sim_class.sim_type
+    version = sim_class.version
+    arguments = [encode_point(point) for point in points]
+
+    con = lite.connect('sim.db')
+    with con:
+        cur = con.cursor()
+        cur.executemany('''
+            insert or ignore into sweep_jobs(sim_type, sim_version, arguments, status)
+                values(?, ?, ?, 'pending')''', [(sim_type,version,a) for a in arguments])
+        cur.execute('''
+            update sweep_jobs set status = 'pending'
+                where sim_type = ? and sim_version = ? and status = 'running' ''', (sim_type,version))
+        cur.execute('''
+            select id, arguments from sweep_jobs
+                where sim_type = ? and sim_version = ? and status = 'pending' ''', (sim_type,version))
+        wanted = set(arguments)
+        jobs = [(job_id,a) for job_id,a in cur.fetchall() if a in wanted]
+
+    completed = []
+    sink = result_sink(flush_size=flush_size,flush_interval=flush_interval)
+    missing = []
+    found = []
+    for job_id,a in jobs:
+        results = sink.lookup(sim_class(**json.loads(a)))
+        if results is None:
+            missing.append((job_id,a))
+        else:
+            found.append(job_id)
+            completed.append((json.loads(a),results))
+    mark_done(con,found)
+    jobs = missing
+    with con:
+        con.executemany("update sweep_jobs set status = 'running' where id = ?", [(job_id,) for job_id,a in jobs])
+
+    written = [] #jobs whose results have been queued, but not necessarily written yet
+    error = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job,sim_class,a,profiles is not None):(job_id,a) for job_id,a in jobs}
+        for future in as_completed(futures):
+            job_id, a = futures[future]
+            try:
+                if profiles is None:
+                    (mean,stdev,reliability) = future.result()
+                else:
+                    ((mean,stdev,reliability),report) = future.result()
+                    profiles.append(report)
+            except Exception as e:
+                #put the job back in the queue, and raise the error once everything else is finished
+                with con:
+                    con.execute("update sweep_jobs set status = 'pending' where id = ?", (job_id,))
+                error = e
+                continue
+
+            sim = sim_class(**json.loads(a))
+            sim.sink = sink
+            if np.isnan(mean):
+                sim.write_to_sql(0,0,reliability)
+            else:
+                sim.write_to_sql(mean,stdev,reliability)
+            written.append(job_id)
+            if len(sink.queue) == 0:
+                mark_done(con,written)
+                written = []
+            completed.append((json.loads(a),(mean,stdev,reliability)))
+    sink.close()
+    mark_done(con,written)
+    con.close()
+
+    if error is not None:
+        raise error
+    return completed
+
+#Runs a monte carlo sim_class at every point, using the same random numbers for each (common random numbers).
+#Each turn is simulated with the same stream of random numbers at every point, so the results change smoothly from point to point,
+#and differences between neighboring points (e.g. np.diff or np.gradient of the results) have far less noise than independent runs.
+#Results are always simulated (not looked up), and written to the database as usual.
+#Returns an array with a row of (mean,stdev,reliability) for each point.
+def crn_sweep(sim_class,points,seed=0):
+    stream = uniform_stream(seed)
+    return np.array([sim_class(**point).sim(force=True,common_stream=stream) for point in points])
+
+#######################################
+###### Phase boundary tracing #########
+#######################################
+
+#Returns the reliability of sim_class at each point (a list of dicts of constructor arguments).
+#Points already in the database are looked up, and the rest are simulated and stored.  With workers other than 1,
+#the missing points are run in parallel with run_sweep first.  Points the constructor rejects get nan.
+def point_reliability(sim_class,points,workers=1):
+    reliability = np.full(len(points),np.nan)
+    missing = []
+    for k in range(len(points)):
+        try:
+            sim = sim_class(**points[k])
+        except ValueError:
+            continue
+        results = sim.sink.lookup(sim)
+        if results is None:
+            missing.append(k)
+        else:
+            reliability[k] = results[2]
+    if workers != 1 and len(missing) > 0:
+        run_sweep(sim_class,[points[k] for k in missing],workers=workers)
+    for k in missing:
+        reliability[k] = sim_class(**points[k]).sim()[2]
+    return reliability
+
+#Finds where reliability crosses threshold along one parameter (name), between lo and hi, by bisection.
+#Other constructor arguments are given as keywords.  Returns the final (lo,hi) bracket, which is narrower than tolerance.
+def bisect_boundary(sim_class,name,lo,hi,threshold=.01,tolerance=.001,**fixed):
+    (lo_above,hi_above) = point_reliability(sim_class,[dict(fixed,**{name:lo}),dict(fixed,**{name:hi})]) > threshold
+    if lo_above == hi_above:
+        raise ValueError("Error: expected reliability to cross the threshold between lo and hi")
+    while hi - lo > tolerance:
+        middle = round((lo + hi)/2,10)
+        middle_above = point_reliability(sim_class,[dict(fixed,**{name:middle})])[0] > threshold
+        if middle_above == lo_above:
+            lo = middle
+        else:
+            hi = middle
+    return (lo,hi)
+
+#Traces the boundary where reliability crosses threshold, over two parameters (x_name and y_name, over x_range and y_range).
+#This starts with an initial x initial grid of cells, and simulates the corners of each cell.  Cells whose corners disagree
+#(some above threshold and some below) are split into four, and this is repeated levels times.
+#So only cells along the boundary are refined, down to a resolution of initial*2**levels.
+#The initial grid has to be fine enough that every part of the boundary passes between corners that disagree.
+#Returns (reliability, boundary), where reliability is a dict of {(x,y):reliability} for every point used,
+#and boundary is a list of the finest cells that straddle the boundary, as (x_lo,y_lo,x_hi,y_hi).
+#e.g. find_boundary(markov_vsm_inf,'fraction_smithies',(0,1),'fraction_villages',(0,1),max_cards=1000)
+def find_boundary(sim_class,x_name,x_range,y_name,y_range,threshold=.01,initial=8,levels=4,workers=1,**fixed):
+    size = 2**levels
+    n = initial*size
+    #Corners are kept as integer coordinates on the finest grid, so that the same point always has the same parameters
+    def position(i,j):
+        return (round(x_range[0] + i*(x_range[1]-x_range[0])/n,10),round(y_range[0] + j*(y_range[1]-y_range[0])/n,10))
+    
+    corner_reliability = {}
+    cells = [(i*size,j*size,size) for i in range(initial) for j in range(initial)]
+    for level in range(levels+1):
+        corners = set()
+        for (i,j,width) in cells:
+            corners.update([(i,j),(i+width,j),(i,j+width),(i+width,j+width)])
+        corners = [corner for corner in corners if corner not in corner_reliability]
+        points = [dict(fixed,**dict(zip((x_name,y_name),position(*corner)))) for corner in corners]
+        corner_reliability.update(zip(corners,point_reliability(sim_class,points,workers)))
+        
+        straddling = []
+        for (i,j,width) in cells:
+            values = np.array([corner_reliability[corner] for corner in [(i,j),(i+width,j),(i,j+width),(i+width,j+width)]])
+            values = values[~np.isnan(values)]
+            if np.any(values > threshold) and not np.all(values > threshold):
+                straddling.append((i,j,width))
+        if level == levels:
+            break
+        cells = []
+        for (i,j,width) in straddling:
+            half = width//2
+            cells.extend([(i,j,half),(i+half,j,half),(i,j+half,half),(i+half,j+half,half)])
+    
+    reliability = {position(*corner):value for corner,value in corner_reliability.items()}
+    boundary = [position(i,j) + position(i+width,j+width) for (i,j,width) in straddling]
+    return (reliability,boundary)